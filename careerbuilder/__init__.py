@@ -5,4 +5,6 @@ from things_loaders import *
 from tokens import *
 from recommender import *
 from similarity import *
-from zips import *
\ No newline at end of file
+from zips import *
+from ann import *
+from metrics import *
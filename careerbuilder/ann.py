@@ -0,0 +1,230 @@
+'''
+Approximate nearest neighbour search over the SVD factor space.
+
+Jobs (rows of JobsMat / UserJobSimilarity.J) are split into cells by k-means,
+an inverted file (IVF).  A query scores the cell centroids, probes the
+n_probe best cells and scores only the jobs in them exactly, so n_probe
+trades speed for recall.  One index is built per WindowID, since users are
+only recommended jobs from their own window.
+'''
+import os
+import time
+from scipy.sparse import csr_matrix
+from pylab import *
+from similarity import UserJobSimilarity
+
+def kmeans(X, n_clusters, n_iter=20, seed=0, block=2**16):
+    '''
+    Lloyd's k-means on the rows of X
+
+    Parameters
+    ----------
+    X: numpy array
+       the points, one per row
+    n_clusters: int
+                number of clusters
+    n_iter: int
+            number of assign/update rounds
+    seed: int
+          seed for the initial centroids and reseeding empty clusters
+    block: int
+           number of rows assigned at a time, bounds the distance matrix
+
+    Returns
+    -------
+    (centroids, labels) - numpy arrays
+    '''
+    rs = np.random.RandomState(seed)
+    n_clusters = min(n_clusters, X.shape[0])
+    C = X[rs.choice(X.shape[0], n_clusters, replace=False),:].astype(float64)
+    labels = zeros(X.shape[0], dtype=intp)
+    for it in xrange(n_iter):
+        labels = assign(X, C, block)
+        counts = bincount(labels, minlength=n_clusters)
+        # sum the points of each cluster with a sparse one-hot product
+        onehot = csr_matrix((ones(X.shape[0]), (labels, arange(X.shape[0]))),
+                            shape=(n_clusters, X.shape[0]))
+        sums = asarray(onehot.dot(X), dtype=float64)
+        empty = counts == 0
+        C[~empty] = sums[~empty] / counts[~empty][:,None]
+        # reseed empty clusters with random points
+        C[empty] = X[rs.randint(0, X.shape[0], empty.sum()),:]
+    return C, assign(X, C, block)
+
+def assign(X, C, block=2**16):
+    '''index of the nearest (euclidean) row of C for each row of X'''
+    c_sq = (C**2).sum(axis=1)
+    labels = zeros(X.shape[0], dtype=intp)
+    for start in xrange(0, X.shape[0], block):
+        # |x-c|^2 = |x|^2 - 2x.c + |c|^2, and |x|^2 doesn't change the argmin
+        d = c_sq - 2 * dot(X[start:start+block,:], C.T)
+        labels[start:start+block] = argmin(d, axis=1)
+    return labels
+
+class IVFIndex(object):
+
+    def __init__(self, centroids, offsets, inds):
+        '''
+        Parameters
+        ----------
+        centroids: numpy array
+                   one row per cell
+        offsets: numpy array
+                 the jobs of cell c are inds[offsets[c]:offsets[c+1]]
+        inds: numpy array
+              row indices into the factor matrix, grouped by cell
+        '''
+        self.centroids, self.offsets, self.inds = centroids, offsets, inds
+
+    def __len__(self):
+        return len(self.inds)
+
+    @staticmethod
+    def build(X, inds, n_cells=None, n_iter=20, seed=0):
+        '''
+        Builds an index over the rows inds of X
+
+        n_cells: number of k-means cells, defaults to sqrt(len(inds))
+        '''
+        inds = asarray(inds)
+        if n_cells is None:
+            n_cells = int(ceil(sqrt(len(inds))))
+        C, labels = kmeans(X[inds,:], max(1, n_cells), n_iter, seed)
+        order = argsort(labels, kind='mergesort')
+        offsets = concatenate([[0], cumsum(bincount(labels, minlength=len(C)))])
+        return IVFIndex(C, offsets, inds[order])
+
+    def candidates(self, vec, n_probe):
+        '''the indices in the n_probe cells whose centroids are most similar to vec'''
+        n_cells = len(self.centroids)
+        if n_probe >= n_cells:
+            return self.inds
+        if n_probe <= 0:
+            return self.inds[:0]
+        cell_sims = dot(self.centroids, vec)
+        probe = argpartition(cell_sims, n_cells - n_probe)[n_cells - n_probe:]
+        return concatenate([self.inds[self.offsets[c]:self.offsets[c+1]] for c in probe])
+
+    def save(self, f_name):
+        savez(f_name, centroids=self.centroids, offsets=self.offsets, inds=self.inds)
+
+    @staticmethod
+    def load(f_name):
+        data = load(f_name)
+        return IVFIndex(data['centroids'], data['offsets'], data['inds'])
+
+class WindowANN(object):
+
+    def __init__(self, JobsMat, indexes, n_probe=8):
+        '''
+        Parameters
+        ----------
+        JobsMat: numpy array
+                 the job factors the indexes point into
+        indexes: dict
+                 maps WindowIDs to their IVFIndex
+        n_probe: int
+                 default number of cells probed per query
+        '''
+        self.JobsMat, self.indexes, self.n_probe = JobsMat, indexes, n_probe
+
+    @staticmethod
+    def build(JobsMat, WindInds, n_cells=None, n_iter=20, seed=0, n_probe=8, verbose=False):
+        '''
+        Builds one IVFIndex per window over the jobs of that window
+
+        Parameters
+        ----------
+        JobsMat: numpy array
+                 the job factors
+        WindInds: WindowIndices instance
+                  the jobs of each window
+        n_cells: int, optional
+                 cells per window, defaults to sqrt of the window's job count
+        verbose: boolean
+                 if true, prints the size of each window's index
+        '''
+        indexes = {}
+        for w_id, inds in WindInds.wid_to_jind.iteritems():
+            indexes[w_id] = IVFIndex.build(JobsMat, inds, n_cells, n_iter, seed)
+            if verbose:
+                print 'window %s: %d jobs in %d cells' % (w_id, len(inds), len(indexes[w_id].centroids))
+        return WindowANN(JobsMat, indexes, n_probe)
+
+    def query(self, window_id, vec, k, n_probe=None, exclude=None):
+        '''
+        Approximate top k jobs of a window for vec
+
+        Parameters
+        ----------
+        window_id: int
+        vec: numpy array
+             the user's factors
+        k: int or None
+           number of jobs to return, None returns every probed job
+        n_probe: int, optional
+                 number of cells to probe, defaults to self.n_probe
+        exclude: numpy array, optional
+                 job indices not to return (e.g. applied jobs)
+
+        Returns
+        -------
+        (inds, sims) - numpy arrays, from highest similarity to lowest
+        '''
+        if n_probe is None:
+            n_probe = self.n_probe
+        cands = self.indexes[window_id].candidates(vec, n_probe)
+        if exclude is not None and len(exclude):
+            cands = cands[~in1d(cands, exclude)]
+        sims = dot(self.JobsMat[cands,:], vec)
+        return UserJobSimilarity.top_k(sims, cands, k)
+
+    def recall(self, UsersMat, u_inds, windows, k, n_probe=None):
+        '''
+        mean recall@k of query against exact search over the whole window,
+        for users u_inds in windows
+        '''
+        hits = []
+        for u, w in zip(u_inds, windows):
+            vec = UsersMat[u,:]
+            inds = self.indexes[w].inds
+            exact = UserJobSimilarity.top_k(dot(self.JobsMat[inds,:], vec), inds, k)[0]
+            approx = self.query(w, vec, k, n_probe)[0]
+            if len(exact):
+                hits.append(len(intersect1d(exact, approx)) / float(len(exact)))
+        return mean(hits)
+
+    def recall_report(self, UsersMat, u_inds, windows, k=150, probes=(1, 2, 4, 8, 16, 32)):
+        '''
+        prints recall@k and query time for each probe count
+
+        Returns
+        -------
+        list of (n_probe, recall, seconds per query)
+        '''
+        report = []
+        for n_probe in probes:
+            t = time.time()
+            for u, w in zip(u_inds, windows):
+                self.query(w, UsersMat[u,:], k, n_probe)
+            secs = (time.time() - t) / max(1, len(u_inds))
+            rec = self.recall(UsersMat, u_inds, windows, k, n_probe)
+            print 'n_probe %d: recall@%d %.4f, %.3f ms/query' % (n_probe, k, rec, 1000*secs)
+            report.append((n_probe, rec, secs))
+        return report
+
+    def save(self, out_dir):
+        '''saves each window's index to out_dir/window_<id>.npz'''
+        if not os.path.exists(out_dir):
+            os.makedirs(out_dir)
+        for w_id, index in self.indexes.iteritems():
+            index.save(os.path.join(out_dir, 'window_%d.npz' % w_id))
+
+    @staticmethod
+    def load(in_dir, JobsMat, n_probe=8):
+        indexes = {}
+        for f_name in os.listdir(in_dir):
+            if f_name.startswith('window_') and f_name.endswith('.npz'):
+                w_id = int(f_name[len('window_'):-len('.npz')])
+                indexes[w_id] = IVFIndex.load(os.path.join(in_dir, f_name))
+        return WindowANN(JobsMat, indexes, n_probe)
@@ -1,7 +1,6 @@
 sys.path.append('/media/git/kaggle/')
 from careerbuilder import *
 from scipy.io import mmread
-numpy.seterr(all='raise')
 from sklearn import preprocessing
 from sklearn.linear_model import LogisticRegression
 
@@ -24,7 +23,7 @@ class Classifier(object):
     '''
     
     def __init__(self, Users, UserTokens, Jobs, JobTokens, UserJobSim, Zips,
-                 job_occurs_f, wind_dates_f):
+                 job_occurs_f, wind_dates_f, geo_dir=None, wind_inds_f=None):
         '''
         Parameters
         ----------
@@ -32,15 +31,19 @@ class Classifier(object):
                       location of user-job occurs file
         wind_dates_f: str
                       location of window dates file (came with kaggle CB data)
+        geo_dir: str, optional
+                 location of the precomputed user/job geocodes (see GeoCodes)
+        wind_inds_f: str, optional
+                     location of the saved window indices (see WindowIndices)
         '''
         self.Users = Users
         self.UserTokens = UserTokens
         self.Jobs = Jobs
         self.JobTokens = JobTokens
         self.UserJobSim = UserJobSim
-        self.JobDistFilt = JobDistanceFilter(Users,Jobs,JobTokens,Zips)
+        self.JobDistFilt = JobDistanceFilter(Users,Jobs,JobTokens,Zips,UserTokens,geo_dir)
         self.JobsAppd = JobsAppliedFilter(job_occurs_f)
-        self.WindInds = WindowIndices(wind_dates_f, self.Jobs, self.JobTokens)
+        self.WindInds = WindowIndices(wind_dates_f, self.Jobs, self.JobTokens, wind_inds_f)
 
     def classify_user(self, u_ind):
         jobs_features, jobs = self.user_jobs_features(u_ind)
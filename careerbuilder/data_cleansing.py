@@ -1,26 +1,75 @@
 import re
+import heapq
 import operator
+from collections import OrderedDict
 from pylab import *
 
+BOILERPLATE = re.compile(r'[A-Z][A-Z0-9 .\?\,\(\)]{6,}\s+')
+CAMEL_CASE = re.compile("([a-z])([A-Z])")
+NON_ALPHA = re.compile('[^a-zA-Z ]')
+SINGLE_LETTER = re.compile(' [a-z] ')
+EXTRA_SPACES = re.compile(' {2,}')
+
 class StringCleaner(object):
     
-    def __init__(self, stopwords_f=None):
+    def __init__(self, stopwords_f=None, cache_size=2**16, cache_max_len=256):
+        '''
+        stopwords_f: str
+                     file with one stop word per line
+        cache_size: int
+                    number of cleaned strings kept in an LRU cache (0 disables it)
+        cache_max_len: int
+                       only strings up to this length are cached, so titles and
+                       majors are while long one-off descriptions are not
+        '''
         if stopwords_f is not None:
             self.stop_words = self.load_stop_words(stopwords_f)
+        self.cache_size, self.cache_max_len = cache_size, cache_max_len
+        self.clear_cache()
         
     def clean(self, s, rem_stopwords=True, badlist=None):
-        s = re.sub(r'[A-Z][A-Z0-9 .\?\,\(\)]{6,}\s+',' ',s) # remove boilerplate
-        s = re.sub("([a-z])([A-Z])","\g<1> \g<2>",s) #split camelCase words
+        '''clean s, returning the cached result if s was cleaned the same way before'''
+        if self.cache_size <= 0 or len(s) > self.cache_max_len:
+            return self._clean(s, rem_stopwords, badlist)
+        key = (s, rem_stopwords, None if badlist is None else tuple(badlist))
+        try:
+            cleaned = self.cache.pop(key)
+            self.hits += 1
+        except KeyError:
+            cleaned = self._clean(s, rem_stopwords, badlist)
+            self.misses += 1
+            if len(self.cache) >= self.cache_size:
+                self.cache.popitem(last=False)
+        self.cache[key] = cleaned
+        return cleaned
+    
+    def clear_cache(self):
+        '''empty the cache and reset its counters (e.g. after changing stop_words)'''
+        self.cache = OrderedDict()
+        self.hits, self.misses = 0, 0
+        
+    def cache_info(self):
+        return {'hits':self.hits, 'misses':self.misses, 'size':len(self.cache),
+                'max_size':self.cache_size}
+        
+    def _clean(self, s, rem_stopwords=True, badlist=None):
+        s = BOILERPLATE.sub(' ',s) # remove boilerplate
+        s = CAMEL_CASE.sub("\g<1> \g<2>",s) #split camelCase words
         s = s.lower()
         if badlist is not None:
             s = self.remove_bad(s, badlist)
-        s = re.sub('[^a-zA-Z ]',' ',s)
-        s = re.sub(' [a-z] ', ' ', s) #remove single letters
+        s = NON_ALPHA.sub(' ',s)
+        s = SINGLE_LETTER.sub(' ', s) #remove single letters
         if rem_stopwords:
             s = self.remove_stop_words(s)
-        s = re.sub(' {2,}',' ',s) # remove extra spaces
+        s = EXTRA_SPACES.sub(' ',s) # remove extra spaces
         return s
     
+    def clean_many(self, strings, rem_stopwords=True, badlist=None):
+        '''a generator of the cleaned strings in the iterable strings'''
+        for s in strings:
+            yield self.clean(s, rem_stopwords, badlist)
+    
     def remove_bad(self, s, badlist):
         for b in badlist:
             s = s.replace(b,' ')
@@ -36,12 +85,39 @@ class StringCleaner(object):
         return stop_words
     
     def remove_stop_words(self, s):
-        '''remove stop words from self.words'''
-        for w in self.stop_words:
-            w_s = ' %s ' % w
-            if w_s in s:
-                s = s.replace(w_s,' ')
-        return s
+        '''
+        remove stop words from s
+
+        Only stop words with a space on both sides are removed and a space is
+        not shared between two removals (so of two adjacent copies of a stop
+        word only the first goes), exactly as replacing ' word ' with ' '
+        for each stop word in turn would do.  Only the stop words that occur
+        in s are visited, by set membership, in the stop word set's order.
+        '''
+        words = s.split(' ')
+        present = self.stop_words.intersection(words[1:-1])
+        if not present:
+            return s
+        rank = self._stop_word_rank()
+        for w in sorted(present, key=rank.__getitem__):
+            kept = [words[0]]
+            removed = False
+            for i in xrange(1, len(words) - 1):
+                if not removed and words[i] == w:
+                    removed = True
+                    continue
+                removed = False
+                kept.append(words[i])
+            kept.append(words[-1])
+            words = kept
+        return ' '.join(words)
+    
+    def _stop_word_rank(self):
+        '''position of each stop word in the iteration order of self.stop_words'''
+        if getattr(self, '_rank_of', None) is not self.stop_words:
+            self._rank = dict((w,i) for i,w in enumerate(self.stop_words))
+            self._rank_of = self.stop_words
+        return self._rank
 
 
 class WordCounter(object):
@@ -70,23 +146,119 @@ class WordCounter(object):
         
     def prune_by_count(self, count):
         '''remove words in self.words with counts less than count'''
-        words = self.get_ordered_list()
-        for w,c in words:
-            if c < count:
-                self.words.pop(w)
+        for w in [w for w,c in self.words.iteritems() if c < count]:
+            self.words.pop(w)
                 
     def keep_top_N(self, N):
         '''keep only the top N most freq words in self.words'''
-        pop_words = self.get_ordered_list()[N:]
-        for w,v in pop_words:
+        if N >= len(self.words):
+            return
+        keep = set(w for w,c in self.get_ordered_list(N))
+        for w in [w for w in self.words.iterkeys() if w not in keep]:
             self.words.pop(w)
         
-    def get_ordered_list(self):
+    def get_ordered_list(self, N=None):
         '''return an ordered list (greatest to fewest) of words and
-        their counts'''
-        w_list = sorted(self.words.iteritems(), key=operator.itemgetter(1))
+        their counts, only the top N if N is given (selected with a heap
+        rather than a full sort).  Ties come in reverse dict order.'''
+        w_list = self.words.items()
         w_list.reverse()
-        return w_list
+        if N is None:
+            return sorted(w_list, key=operator.itemgetter(1), reverse=True)
+        return heapq.nlargest(N, w_list, key=operator.itemgetter(1))
     
     def get_word_list(self):
-        return [w for w in self.words.iterkeys()]
\ No newline at end of file
+        return [w for w in self.words.iterkeys()]
+    
+    def merge(self, words):
+        '''add the counts in the {word: count} dictionary words'''
+        for w, c in words.iteritems():
+            self.words[w] = self.words.get(w,0) + c
+            
+    def spawn(self):
+        '''an empty counter of the same kind, e.g. for a worker process'''
+        return WordCounter()
+    
+    def merge_counter(self, other):
+        '''add the counts of another counter made by spawn'''
+        self.merge(other.words)
+
+
+class ApproxWordCounter(WordCounter):
+    '''
+    A WordCounter for a fixed memory budget.  Every word is counted in a
+    count-min sketch (depth rows of width counters) and only the words with
+    the largest estimated counts (the heavy hitters) are kept in self.words,
+    between max_words and 2 * max_words of them.  Counts are estimates that
+    can only be too high, by at most ~e/width of the total count with
+    probability 1 - exp(-depth).
+    '''
+    
+    def __init__(self, max_words=100000, width=2**20, depth=4, seed=0):
+        '''width is rounded up to a power of 2'''
+        WordCounter.__init__(self)
+        self.max_words = max_words
+        self.bits = int(ceil(log2(width)))
+        self.sketch = zeros((depth, 2**self.bits), dtype=int64)
+        rs = np.random.RandomState(seed)
+        # multiply-shift hashing: odd multipliers and offsets, one per row
+        self.mult = rs.randint(0, 2**62, depth).astype(uint64) * uint64(2) + uint64(1)
+        self.offset = rs.randint(0, 2**62, depth).astype(uint64)
+        
+    def _columns(self, words):
+        '''the sketch column of each word in each row, shape (depth, len(words))'''
+        h = array([hash(w) for w in words], dtype=int64).view(uint64)
+        old = seterr(over='ignore')
+        try:
+            cols = (self.mult[:,None] * h[None,:] + self.offset[:,None]) >> uint64(64 - self.bits)
+        finally:
+            seterr(**old)
+        return cols.astype(int64)
+    
+    def count_words(self, s):
+        self.add_counts(s.strip().split(' '), 1)
+        
+    def merge(self, words):
+        self.add_counts(words.keys(), array(words.values(), dtype=int64))
+        
+    def spawn(self):
+        '''an empty counter with the same budget and hashing, so sketches can be merged'''
+        WC = ApproxWordCounter(self.max_words, 2**self.bits, self.sketch.shape[0])
+        WC.mult, WC.offset = self.mult, self.offset
+        return WC
+    
+    def merge_counter(self, other):
+        '''
+        add the counts of a counter made by spawn: the sketches are summed
+        and the heavy hitters of both are re-estimated from the sum
+        '''
+        self.sketch += other.sketch
+        words = list(set(self.words) | set(other.words))
+        if len(words) == 0:
+            return
+        self.words = dict(zip(words, self._estimates(self._columns(words)).tolist()))
+        if len(self.words) > 2 * self.max_words:
+            WordCounter.keep_top_N(self, self.max_words)
+    
+    def _estimates(self, cols):
+        '''the count estimates of the words with sketch columns cols'''
+        rows = arange(self.sketch.shape[0])[:,None]
+        return self.sketch[rows, cols].min(axis=0)
+        
+    def add_counts(self, words, counts):
+        '''add counts (an int or an array) to the words in the list words'''
+        if len(words) == 0:
+            return
+        cols = self._columns(words)
+        for r in range(self.sketch.shape[0]):
+            np.add.at(self.sketch[r], cols[r], counts)
+        estimates = self._estimates(cols)
+        for w, c in zip(words, estimates.tolist()):
+            self.words[w] = c
+        if len(self.words) > 2 * self.max_words:
+            WordCounter.keep_top_N(self, self.max_words)
+            
+    def estimate(self, w):
+        '''the estimated count of any word, heavy hitter or not'''
+        cols = self._columns([w])
+        return int(self.sketch[arange(self.sketch.shape[0]), cols[:,0]].min())
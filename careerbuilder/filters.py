@@ -1,8 +1,11 @@
+import os
 import datetime
+import hashlib
 from itertools import izip
 from scipy.io import mmread
-from numpy.lib.arraysetops import setdiff1d
 from pylab import *
+from generalized_occurs import load_csr
+from zips import SpatialIndex, GeoCodes
 
 class Filter(object):
        
@@ -13,7 +16,14 @@ class Filter(object):
 class JobsAppliedFilter(Filter):
     
     def __init__(self, user_job_occurs_f):
-        self.UserJobOccurs = mmread(user_job_occurs_f).tocsr()
+        '''
+        user_job_occurs_f is either a MatrixMarket file or a directory
+        written by Occurs.save_occurs(..., format='csr'), which is memory-mapped
+        '''
+        if os.path.isdir(user_job_occurs_f):
+            self.UserJobOccurs = load_csr(user_job_occurs_f)
+        else:
+            self.UserJobOccurs = mmread(user_job_occurs_f).tocsr()
     
     def filter(self, u_ind, job_inds, return_appd=False):
         '''
@@ -36,13 +46,66 @@ class JobsAppliedFilter(Filter):
         Optionally, returns the jobs the user applied to as well.
         '''
         
-        applied_inds = nonzero(self.UserJobOccurs[u_ind,:])[1]
-        filtered = setdiff1d(job_inds,applied_inds)
+        applied_inds = self.applied(u_ind)
+        filtered = JobsAppliedFilter.exclude(unique(job_inds),applied_inds)
         if return_appd:
             return filtered, applied_inds
         else:
             return filtered 
         
+    def filter_many(self, u_inds, job_inds, windows=None, return_appd=False):
+        '''
+        Removes the jobs each of many users has already applied to.
+
+        Parameters
+        ----------
+        u_inds: numpy array of ints
+                indices in the User-Job application co-occur matrix
+        job_inds: numpy array of ints, or dict
+                  the candidate job indices shared by all users, or a dict
+                  mapping window ids to each window's candidates
+        windows: numpy array of ints
+                 the window id of each user, needed if job_inds is a dict
+        return_appd: boolean
+                     if True, return the jobs applied to by each user as well
+                     
+        Returns
+        -------
+        A list with the filtered job indices of each user (the same arrays
+        filter returns), optionally also a list of the jobs each applied to.
+        '''
+        if windows is None:
+            shared = unique(job_inds)
+        candidates = {}
+        filtered, appd = [], []
+        for i, u_ind in enumerate(u_inds):
+            if windows is None:
+                cand = shared
+            else:
+                cand = candidates.get(windows[i])
+                if cand is None:
+                    cand = candidates[windows[i]] = unique(job_inds[windows[i]])
+            applied_inds = self.applied(u_ind)
+            filtered.append(JobsAppliedFilter.exclude(cand,applied_inds))
+            appd.append(applied_inds)
+        if return_appd:
+            return filtered, appd
+        return filtered
+    
+    def applied(self, u_ind):
+        '''the jobs u_ind applied to, read straight from the CSR arrays'''
+        occurs = self.UserJobOccurs
+        start, end = occurs.indptr[u_ind], occurs.indptr[u_ind+1]
+        return occurs.indices[start:end][occurs.data[start:end] != 0]
+    
+    @staticmethod
+    def exclude(sorted_inds, inds):
+        '''sorted_inds (sorted, unique) without the values in inds, by binary search'''
+        if len(sorted_inds) == 0 or len(inds) == 0:
+            return sorted_inds.copy()
+        pos = searchsorted(sorted_inds,inds).clip(0,len(sorted_inds)-1)
+        return delete(sorted_inds,pos[sorted_inds[pos] == inds])
+        
     def get_occurs(self):
         '''
         Returns
@@ -62,14 +125,33 @@ class JobsAppliedFilter(Filter):
 
 class JobDistanceFilter(Filter):
     
-    def __init__(self, Users, Jobs, JobTokens, Zips):
+    def __init__(self, Users, Jobs, JobTokens, Zips, UserTokens=None, geo_dir=None):
+        '''
+        Parameters
+        ----------
+        UserTokens: a Tokens instance, optional
+                    needed to use the precomputed user geocodes
+        geo_dir: str, optional
+                 directory of the precomputed geocodes (users.geo.*, jobs.geo.*,
+                 see GeoCodes); they are built there on first use.  Without it
+                 every job is geocoded here and users on every filter call.
+        '''
         self.Users = Users
         self.Jobs, self.JobTokens = Jobs, JobTokens
         self.Zips = Zips
-        self.job_latlong = self.job_inds_to_latlong()
+        self.UserTokens, self.user_geo = UserTokens, None
+        if geo_dir is not None:
+            job_geo = GeoCodes.cached(os.path.join(geo_dir,'jobs.geo'), Jobs, JobTokens, Zips)
+            self.job_latlong = job_geo.latlong
+            self.bad_loc = int((~job_geo.known).sum())
+            if UserTokens is not None:
+                self.user_geo = GeoCodes.cached(os.path.join(geo_dir,'users.geo'), Users,
+                                                UserTokens, Zips)
+        else:
+            self.job_latlong = self.job_inds_to_latlong()
     
     def filter(self, u_tok, j_inds, max_dist=None, return_dists=False,
-               return_all=False):
+               return_all=False, index=None):
         '''
         Filter a list of job indices by their distance from the user
 
@@ -86,6 +168,9 @@ class JobDistanceFilter(Filter):
                       if true, return a list of tuples, e.g. [(j_ind, dist),...]  
         return_all: boolean
                     if true, returns values of -1 where we don't know distance
+        index: (SpatialIndex, job indices), optional
+               an index over a subset of the jobs containing j_inds (see
+               subset_index) to search instead of the index over all jobs
         
         Returns
         -------
@@ -94,14 +179,21 @@ class JobDistanceFilter(Filter):
         if max_dist is None and return_dists == False:
             raise Exception('must set max_dist to float or return_dists to True')
         
-        if return_all:
-            thr = -1.0    
-        u_lat_long = self.find_lat_long(u_tok, self.Users)
+        # distances of -1 (unknown) only pass if return_all
+        thr = -1.0 if return_all else 0.0
+        u_lat_long = self.user_lat_long(u_tok)
         if u_lat_long is None:
             if return_all and return_dists:
                 return j_inds, -1.0 * ones_like(j_inds)
             return []
         u_lat, u_long = u_lat_long
+        if not return_dists and not return_all:
+            # only the jobs the spatial index finds within max_dist can pass
+            if index is None:
+                near, dists = self.spatial_index().query_radius(u_lat, u_long, max_dist)
+            else:
+                near = index[1][index[0].query_radius(u_lat, u_long, max_dist)[0]]
+            return list(j_inds[in1d(j_inds, near)])
         j_lats, j_longs = self.job_latlong[j_inds,0], self.job_latlong[j_inds,1]
         dists = self.Zips.lat_long_dist(u_lat,u_long,j_lats,j_longs)
         dists[j_lats == 0.0] = -1
@@ -113,6 +205,52 @@ class JobDistanceFilter(Filter):
             assert j_inds.shape == dists[dists >= thr].shape
             return j_inds[dists >= thr], dists[dists >= thr]
     
+    def spatial_index(self):
+        '''the SpatialIndex over the jobs with a known location, built on first use'''
+        if getattr(self, 'index', None) is None:
+            known = (self.job_latlong[:,0] != 0.0) & (self.job_latlong[:,1] != 0.0)
+            self.index = SpatialIndex(self.job_latlong[:,0], self.job_latlong[:,1], known)
+        return self.index
+    
+    def subset_index(self, j_inds):
+        '''
+        Returns
+        -------
+        (SpatialIndex, j_inds) - an index over just the jobs j_inds, for filter
+        '''
+        lats, longs = self.job_latlong[j_inds,0], self.job_latlong[j_inds,1]
+        return SpatialIndex(lats, longs, (lats != 0.0) & (longs != 0.0)), j_inds
+    
+    def user_lat_long(self, u_tok):
+        '''the user's (lat,long), from the precomputed geocodes if there are any'''
+        if self.user_geo is not None:
+            return self.user_geo.lat_long(self.UserTokens.token2id(u_tok))
+        return self.find_lat_long(u_tok, self.Users)
+    
+    def jobs_within(self, u_tok, max_dist):
+        '''
+        Returns
+        -------
+        (job indices, distances) - all jobs within max_dist miles of the user,
+        nearest first; empty if the user's location is unknown
+        '''
+        u_lat_long = self.user_lat_long(u_tok)
+        if u_lat_long is None:
+            return zeros(0, dtype=int), zeros(0)
+        return self.spatial_index().query_radius(u_lat_long[0], u_lat_long[1], max_dist)
+    
+    def nearest_jobs(self, u_tok, k):
+        '''
+        Returns
+        -------
+        (job indices, distances) - the k jobs nearest to the user, nearest
+        first; empty if the user's location is unknown
+        '''
+        u_lat_long = self.user_lat_long(u_tok)
+        if u_lat_long is None:
+            return zeros(0, dtype=int), zeros(0)
+        return self.spatial_index().query_nearest(u_lat_long[0], u_lat_long[1], k)
+    
     def job_inds_to_latlong(self):
         '''
         Create an array containing lat/long info corresponding to each job (by index)
@@ -145,8 +283,7 @@ class JobDistanceFilter(Filter):
         -------
         (lat,long) coordinate tuple
         '''
-        t = Thing[tok]
-        tzip,tcity,tstate = t['Zip'],t['City'],t['State']
+        tzip,tcity,tstate = [Thing.field(tok,f) for f in ('Zip','City','State')]
         if tzip is not None:
             try:
                 return self.Zips.lat_long_lookup(tzip)
@@ -160,16 +297,59 @@ class JobDistanceFilter(Filter):
 
 class WindowIndices(object):
     
-    def __init__(self, wind_dates_f, Thing, ThingTokens):
+    def __init__(self, wind_dates_f, Thing=None, ThingTokens=None, inds_f=None):
+        '''
+        Parameters
+        ----------
+        wind_dates_f: str
+                      location of window dates file (came with kaggle CB data)
+        Thing, ThingTokens: Things and Tokens instances
+                            (e.g. Jobs, JobTokens), not needed if inds_f exists
+        inds_f: str, optional
+                .npz file (the suffix is added if missing) the window indices
+                are loaded from if it exists, or saved to after they are
+                built.  With ThingTokens, the saved indices are rebuilt if
+                they were saved for other tokens or window dates (see
+                inds_key); changes to Thing alone aren't detected, delete
+                the file to rebuild them.
+        '''
         self.wind_dates = self.load_window_dates(wind_dates_f)
+        key = None if ThingTokens is None else WindowIndices.inds_key(wind_dates_f, ThingTokens)
+        if inds_f is not None:
+            inds_f = WindowIndices.npz_path(inds_f)
+            if os.path.exists(inds_f):
+                self.wid_to_jind, self.n_inds, saved_key = WindowIndices.load(inds_f)
+                if key is None or key == saved_key:
+                    return
+        self.n_inds = ThingTokens.token_count()
         self.wid_to_jind = self.wind2ind(Thing, ThingTokens)
+        if inds_f is not None:
+            self.save(inds_f, key)
+    
+    @staticmethod
+    def npz_path(inds_f):
+        '''inds_f with the .npz suffix savez adds'''
+        return inds_f if inds_f.endswith('.npz') else inds_f + '.npz'
+    
+    @staticmethod
+    def inds_key(wind_dates_f, ThingTokens):
+        '''md5 of the window dates and of the tokens in id order (see GeoCodes.tokens_key)'''
+        md5 = hashlib.md5(GeoCodes.tokens_key(ThingTokens))
+        md5.update(open(wind_dates_f, 'rb').read())
+        return md5.hexdigest()
     
     def __getitem__(self, window_id):
         return self.wid_to_jind[window_id]
     
+    def mask(self, window_id):
+        '''boolean array over all indices, True for those in the window'''
+        m = zeros(self.n_inds, dtype=bool)
+        m[self.wid_to_jind[window_id]] = True
+        return m
+    
     def wind2ind(self, Thing, Tokens, test_period_only=True):
         '''
-        Builds a mapping from windowIDs to list of indices
+        Builds a mapping from windowIDs to sorted arrays of indices
 
         Parameters
         ----------
@@ -183,21 +363,45 @@ class WindowIndices(object):
         
         Returns
         -------
-        dict - a dictionary mapping windowIDs (int) to a list of indices (list of ints)
+        dict - a dictionary mapping windowIDs (int) to a sorted numpy array of indices
         '''
+        tokens = Tokens.ids2tokens_bulk(arange(Tokens.token_count()))[0]
+        w_ids = Thing.fields_of('WindowID', tokens)
+        # only want jobs that are available during the test period
+        end_dates = WindowIndices.to_datetime64(Thing.fields_of('EndDate', tokens))
+        order = argsort(w_ids, kind='mergesort')
+        windows, starts = unique(w_ids[order], return_index=True)
         w2ind = {}
-        for token,ind in Tokens.tokens2ids.iteritems():
-            w_id = Thing[token]['WindowID']
-            # only want jobs that are available during the test period
-            end_date = WindowIndices.to_date(Thing[token]['EndDate'])
-            if end_date < self.wind_dates[w_id]['train_stop_test_start']:
-                continue
-            try:
-                w2ind[w_id].append(ind)
-            except KeyError:
-                w2ind[w_id] = [ind]
+        for w_id, inds in izip(windows.tolist(), split(order, starts[1:])):
+            test_start = datetime64(self.wind_dates[w_id]['train_stop_test_start'], 'us')
+            inds = inds[end_dates[inds] >= test_start]
+            if len(inds):
+                w2ind[w_id] = inds
         return w2ind
     
+    def save(self, inds_f, key=None):
+        '''save the window indices, and the key they were built for, to an .npz file'''
+        windows = array(sorted(self.wid_to_jind.keys()), dtype=int64)
+        inds = [self.wid_to_jind[w] for w in windows.tolist()]
+        offsets = cumsum([0] + [len(i) for i in inds])
+        savez(WindowIndices.npz_path(inds_f), windows=windows, offsets=offsets, n_inds=self.n_inds,
+              inds=concatenate(inds) if inds else zeros(0, dtype=int64), key=str(key or ''))
+        
+    @staticmethod
+    def load(inds_f):
+        '''
+        Returns
+        -------
+        (dict mapping windowIDs to arrays of indices, total number of indices,
+        key they were saved with or None)
+        '''
+        data = load(WindowIndices.npz_path(inds_f))
+        inds, offsets = data['inds'], data['offsets']
+        w2ind = dict((w, inds[offsets[i]:offsets[i+1]])
+                     for i, w in enumerate(data['windows'].tolist()))
+        key = str(data['key']) if 'key' in data.files else ''
+        return w2ind, int(data['n_inds']), key or None
+    
     def load_window_dates(self, wind_file):
         '''
         Builds a mapping from windowIDs to list of indices
@@ -226,6 +430,11 @@ class WindowIndices(object):
                                        'test_stop':WindowIndices.to_date(l[3])}
         return window_dates
             
+    @staticmethod
+    def to_datetime64(date_strs):
+        '''converts an array of date formatted strings to datetime64 at once'''
+        return array(date_strs, dtype='datetime64[us]')
+        
     @staticmethod
     def to_date(date_str):
         '''converts a date formatted string to datetime instance'''
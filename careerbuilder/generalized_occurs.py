@@ -4,262 +4,502 @@ matrix can have a different set of tokens (mapped to their unique row/col number
 
 It currently supports making co-occurrences from a flat file
 '''
+import os
+from itertools import izip
 from pylab import *
-from scipy.sparse import dok_matrix
+from scipy.sparse import coo_matrix, csr_matrix
 from scipy.io import mmwrite
+from parallel import fork_map, shard
+
+def read_chunks(flat_file, chunk_bytes=2**24, header=True):
+    '''
+    Yields lists of lines from flat_file, each list holding roughly chunk_bytes
+    of text, so only one chunk of the file is ever in memory
+    '''
+    f = open(flat_file)
+    if header:
+        f.readline()
+    while True:
+        lines = f.readlines(chunk_bytes)
+        if not lines:
+            break
+        yield lines
+    f.close()
+
+def save_csr(mat, out_dir):
+    '''
+    Saves a sparse matrix as binary CSR arrays in out_dir
+    (indptr.npy, indices.npy, data.npy and shape.npy)
+    '''
+    mat = csr_matrix(mat)
+    mat.sum_duplicates()
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    for name in ('indptr','indices','data'):
+        save(os.path.join(out_dir,name+'.npy'),getattr(mat,name))
+    save(os.path.join(out_dir,'shape.npy'),array(mat.shape,dtype=int64))
+
+def load_csr(in_dir, mmap_mode='r'):
+    '''
+    Loads a matrix written by save_csr
+
+    Parameters
+    ----------
+    in_dir: str
+            directory written by save_csr
+    mmap_mode: str or None
+               passed to numpy.load; with the default 'r' the arrays are
+               memory-mapped read-only and pages are read on demand
+
+    Returns
+    -------
+    CSR Scipy Sparse Matrix
+    '''
+    arrays = [load(os.path.join(in_dir,name+'.npy'),mmap_mode=mmap_mode)
+              for name in ('data','indices','indptr')]
+    shape = tuple(load(os.path.join(in_dir,'shape.npy')))
+    return csr_matrix(tuple(arrays),shape=shape,copy=False)
+
+def save_graphlab(mat, outfile, chunk=2**16):
+    '''save a sparse matrix as GraphLab text, writing chunk lines at a time'''
+    mat = mat.tocoo()
+    f = open(outfile,'w')
+    for start in range(0,mat.nnz,chunk):
+        # GL likes 1-indexing
+        rows = (mat.row[start:start+chunk]+1).tolist()
+        cols = (mat.col[start:start+chunk]+1).tolist()
+        data = mat.data[start:start+chunk]
+        f.write(''.join(['%s %s  %s\n' % t for t in izip(rows,cols,data)]))
+    f.close()
+
+def split_columns(lines, columns, delim='\t'):
+    '''split lines and return a list of the requested columns (lists of strings)'''
+    rows = [l.strip().split(delim) for l in lines]
+    return [[r[c] for r in rows] for c in columns]
+
+class CooAccumulator(object):
+    '''
+    Collects (row, col, value) events in growable numpy buffers and sums
+    the duplicates into a CSR matrix only when the matrix is requested
+    '''
+    
+    def __init__(self, shape, capacity=2**16, max_buffer=None):
+        '''
+        max_buffer: int
+                    if set, the buffers are folded into self.matrix whenever
+                    they hold this many events, which caps their memory
+        '''
+        self.shape = shape
+        self.max_buffer = max_buffer
+        self.rows = zeros(capacity, dtype=int32)
+        self.cols = zeros(capacity, dtype=int32)
+        self.vals = zeros(capacity)
+        self.n = 0
+        self.matrix = csr_matrix(shape)
+        
+    def reserve(self, n):
+        '''make sure the buffers can hold n more events'''
+        needed = self.n + n
+        if needed <= self.rows.shape[0]:
+            return
+        size = max(2 * self.rows.shape[0], needed)
+        for name in ('rows','cols','vals'):
+            old = getattr(self, name)
+            new = zeros(size, dtype=old.dtype)
+            new[:self.n] = old[:self.n]
+            setattr(self, name, new)
+            
+    def add(self, i, j, v=1.0):
+        '''add a single event'''
+        if self.n == self.rows.shape[0]:
+            self.reserve(1)
+        self.rows[self.n], self.cols[self.n], self.vals[self.n] = i, j, v
+        self.n += 1
+        if self.max_buffer is not None and self.n >= self.max_buffer:
+            self.flush()
+        
+    def add_many(self, rows, cols, vals=1.0):
+        '''
+        add a batch of events; rows, cols and vals are broadcast against each
+        other, so e.g. a scalar row can be paired with an array of cols
+        '''
+        rows, cols = broadcast_arrays(asarray(rows),asarray(cols))
+        rows, cols = rows.ravel(), cols.ravel()
+        n = rows.shape[0]
+        if n == 0:
+            return
+        if self.max_buffer is not None and n > self.max_buffer:
+            # never buffer more than max_buffer events at once
+            vals = broadcast_to(asarray(vals), (n,))
+            for start in xrange(0, n, self.max_buffer):
+                end = start + self.max_buffer
+                self.add_many(rows[start:end], cols[start:end], vals[start:end])
+            return
+        self.reserve(n)
+        self.rows[self.n:self.n+n] = rows
+        self.cols[self.n:self.n+n] = cols
+        self.vals[self.n:self.n+n] = vals
+        self.n += n
+        if self.max_buffer is not None and self.n >= self.max_buffer:
+            self.flush()
+        
+    def flush(self):
+        '''sum the buffered events into self.matrix and empty the buffers'''
+        if self.n == 0:
+            return
+        n = self.n
+        m = coo_matrix((self.vals[:n],(self.rows[:n],self.cols[:n])),
+                       shape=self.shape).tocsr()
+        m.sum_duplicates()
+        if self.matrix.nnz:
+            m = self.matrix + m
+        self.matrix = m
+        self.n = 0
+        
+    def add_matrix(self, m):
+        '''add a partial sparse matrix of the same shape to the counts'''
+        self.flush()
+        m = csr_matrix(m)
+        self.matrix = self.matrix + m if self.matrix.nnz else m
+        
+    def tocsr(self):
+        self.flush()
+        return self.matrix
 
 class Occurs(object):
     '''An object for storing and counting co-occurrence between tokens'''
     
-    def __init__(self,tokens1,tokens2):
+    def __init__(self,tokens1,tokens2,max_buffer=2**24):
         '''tokens are instances of Tokens class'''
         self.tokens1 = tokens1
         self.tokens2 = tokens2
-        self.occurs = dok_matrix((tokens1.token_count(),tokens2.token_count()))
+        self._init_occurs(tokens1.token_count(),tokens2.token_count(),max_buffer=max_buffer)
+    
+    def _init_occurs(self, n_rows, n_cols, binary=False, max_buffer=2**24):
+        '''
+        Every builder counts into self.accumulator.  If binary, any cell that
+        was counted at least once is 1.0 in the final matrix.  max_buffer caps
+        the events buffered (by it and by each shard's accumulator) before
+        they are summed into the matrix, None leaves them unbounded
+        '''
+        self.max_buffer = max_buffer
+        self.accumulator = self.new_accumulator((n_rows,n_cols))
+        self.binary = binary
+    
+    def new_accumulator(self, shape=None):
+        '''a CooAccumulator with this builder's shape and max_buffer'''
+        if shape is None:
+            shape = self.accumulator.shape
+        return CooAccumulator(shape, max_buffer=self.max_buffer)
+        
+    @property
+    def occurs(self):
+        '''the co-occurrence counts as a CSR matrix'''
+        occurs = self.accumulator.tocsr()
+        if self.binary:
+            occurs.data[:] = 1.0
+        return occurs
     
     def co_occur_flat_file(self, flat_file, token1_column, token2_column, delim='\t',
-                           header=True, token_as_int = True):
-        '''Iterates through a flat file and co-occurs the tokens in their respective columns'''
-        f = open(flat_file)
-        if header: 
-            f.readline()
-        for l in f:
-            l = l.strip().split(delim)
-            token1, token2 = l[token1_column], l[token2_column]
-            if token_as_int:
-                token1, token2 = int(token1), int(token2)
-            id1, id2 = self.tokens1.token2id(token1), self.tokens2.token2id(token2)
-            self.occurs[id1,id2] += 1
+                           header=True, token_as_int = True, chunk_bytes=2**24):
+        '''
+        Streams through a flat file and co-occurs the tokens in their respective columns
+
+        The file is read chunk_bytes at a time, each chunk's token columns are
+        mapped to ids in one lookup and the chunk is folded into the sparse
+        counts before the next one is read, so memory is bounded by the chunk
+        size plus the size of the result.
+        '''
+        for lines in read_chunks(flat_file, chunk_bytes, header):
+            col1, col2 = split_columns(lines, [token1_column,token2_column], delim)
+            ids1 = Occurs.map_tokens(self.tokens1, col1, token_as_int)
+            ids2 = Occurs.map_tokens(self.tokens2, col2, token_as_int)
+            self.accumulator.add_many(ids1,ids2)
+            self.accumulator.flush()
+            
+    def occur_sharded(self, method, items, workers=1):
+        '''
+        Splits items (e.g. tokens2ids.items()) into shards and counts each
+        shard with self.method, which takes a list of items and returns a
+        partial sparse matrix.  With workers > 1 the shards are counted in
+        that many processes; the partial matrices are summed into the
+        counts, so the result is the same as the serial build.
+        '''
+        if workers > 1:
+            parts = fork_map(self, method, shard(items, workers), workers)
+        else:
+            parts = [getattr(self, method)(items)]
+        for part in parts:
+            self.accumulator.add_matrix(part)
             
     def get_occurs(self):
         return self.occurs
+    
+    @staticmethod
+    def map_tokens(tokens, column, token_as_int=True):
+        '''
+        Maps a whole column of tokens to their ids at once
+
+        Parameters
+        ----------
+        tokens: a Tokens instance
+        column: list of str
+                the raw column values read from a flat file
+        token_as_int: boolean
+                      if true, the values are converted to ints first
+
+        Returns
+        -------
+        numpy array of ids; raises KeyError if a token is unknown
+        '''
+        if len(column) == 0:
+            return zeros(0, dtype=int)
+        if token_as_int:
+            column = array(column).astype(int64)
+        else:
+            column = array(column)
+        ids, missing = tokens.tokens2ids_bulk(column)
+        if missing.any():
+            raise KeyError(column[missing][0])
+        return ids
+    
+    @staticmethod
+    def known_ids(tokens, words):
+        '''the ids of words that are in tokens, unknown words are skipped'''
+        t2i = tokens.tokens2ids
+        ids = [t2i.get(w, -1) for w in words]
+        return [i for i in ids if i >= 0]
         
     def save_occurs(self,outfile,format='mm'):
-        '''save the occurs to disk'''
+        '''
+        save the occurs to disk
+
+        format 'csr' writes a directory of binary arrays that load_csr can
+        memory-map; 'mm' and 'graphlab' write text
+        '''
         if format == 'mm':
             mmwrite(outfile,self.occurs)
         elif format == 'graphlab':
-            f = open(outfile,'w')
-            occurs = self.occurs.tocoo()
-            for i in range(occurs.row.shape[0]):
-                # GL likes 1-indexing
-                f.write('%s %s  %s\n' % (occurs.row[i]+1,occurs.col[i]+1,occurs.data[i]))
-            f.close()
+            save_graphlab(self.occurs,outfile)
+        elif format == 'csr':
+            save_csr(self.occurs,outfile)
         else:
-            raise Exception('format must be mm or graphlab')
+            raise Exception('format must be mm, graphlab or csr')
 
 class AppJobZipUserZip(Occurs):
     '''co-occur when a job in zip is applied to by a user in zip'''
     
-    def __init__(self,Users,Jobs,ZipTokens):
+    def __init__(self,Users,Jobs,ZipTokens, max_buffer=2**24):
         self.Users, self.Jobs = Users, Jobs
         self.ZipTokens = ZipTokens
-        self.occurs = dok_matrix((ZipTokens.token_count(),ZipTokens.token_count()))
+        self._init_occurs(ZipTokens.token_count(),ZipTokens.token_count(),max_buffer=max_buffer)
         self.co_occur('/media/kaggle/careerbuilder/data/apps.tsv')
     
-    def co_occur(self, apps_f):
-        apps_f = open(apps_f)
-        header = apps_f.readline()
-        for l in apps_f:
-            l = l.strip().split('\t')
-            u_tok, j_tok = int(l[0]), int(l[-1])
-            u_zip, j_zip = self.Users[u_tok]['Zip'], self.Jobs[j_tok]['Zip']
-            if u_zip is None or j_zip is None:
-                continue
-            try:
-                u_zip_ind, j_zip_ind = self.ZipTokens.token2id(u_zip), self.ZipTokens.token2id(j_zip)
-            except KeyError:
-                continue
-            self.occurs[j_zip_ind,u_zip_ind] += 1.0        
+    def co_occur(self, apps_f, chunk_bytes=2**24):
+        for lines in read_chunks(apps_f, chunk_bytes):
+            u_toks, j_toks = split_columns(lines, [0,-1])
+            u_zips = self.Users.fields_of('Zip', [int(t) for t in u_toks], missing=None)
+            j_zips = self.Jobs.fields_of('Zip', [int(t) for t in j_toks], missing=None)
+            for u_zip, j_zip in izip(u_zips.tolist(), j_zips.tolist()):
+                if u_zip is None or j_zip is None:
+                    continue
+                try:
+                    u_zip_ind, j_zip_ind = self.ZipTokens.token2id(u_zip), self.ZipTokens.token2id(j_zip)
+                except KeyError:
+                    continue
+                self.accumulator.add(j_zip_ind,u_zip_ind)
+            self.accumulator.flush()
 
 class JobWordsJobOccurs(Occurs):
     '''co-occur job description word tokens with job tokens'''
     
-    def __init__(self, Jobs, JobTokens, JobWordsTokens, StringCleaner, word_type):
+    def __init__(self, Jobs, JobTokens, JobWordsTokens, StringCleaner, word_type, workers=1, max_buffer=2**24):
         self.Jobs = Jobs
         self.JobTokens, self.JobWordsTokens = JobTokens, JobWordsTokens
         self.SC = StringCleaner
         self.html = ['span','font','style','text','decoration','layout','grid','line','size','margin','none',
                      'bold','underline','li','il','ul','align','justify','div','strong','layout','id','pt']
-        self.occurs = dok_matrix((JobWordsTokens.token_count(),JobTokens.token_count()))
-        self.co_occur(word_type)
+        self._init_occurs(JobWordsTokens.token_count(),JobTokens.token_count(),max_buffer=max_buffer)
+        self.co_occur(word_type, workers)
         
-    def co_occur(self,attr):
-        for j_tok, j_id in self.JobTokens.tokens2ids.iteritems():
+    def co_occur(self, attr, workers=1):
+        self.attr = attr
+        self.occur_sharded('_co_occur_shard', self.JobTokens.tokens2ids.items(), workers)
+        
+    def _co_occur_shard(self, items):
+        attr = self.attr
+        acc = self.new_accumulator()
+        for j_tok, j_id in items:
             
             # clean string
             try:
-                j_words = BeautifulSoup(self.Jobs[j_tok][attr]).get_text()
+                j_words = BeautifulSoup(self.Jobs.field(j_tok,attr)).get_text()
             except:
-                j_words = self.Jobs[j_tok][attr]
+                j_words = self.Jobs.field(j_tok,attr)
                 j_words = self.SC.clean(j_words,rem_stopwords=True,badlist=['\\r\\n','\\r'])
                 j_words = self.SC.clean(j_words,rem_stopwords=True,badlist=self.html)
             j_words = self.SC.clean(j_words,rem_stopwords=True,badlist=['\\r\\n','\\r'])
             
             # co-occur words in string with j_id
-            for w in j_words:
-                try:
-                    w_ind = self.JobWordsTokens.token2id(w)
-                except KeyError:
-                    continue
-                self.occurs[w_ind,j_id] += 1.0
+            w_inds = Occurs.known_ids(self.JobWordsTokens,j_words)
+            acc.add_many(w_inds,j_id)
+        return acc.tocsr()
                        
 class JobZipOccurs(Occurs):
     
-    def __init__(self, Jobs, JobTokens, ZipTokens):
+    def __init__(self, Jobs, JobTokens, ZipTokens, max_buffer=2**24):
         self.Jobs = Jobs
         self.JobTokens, self.ZipTokens = JobTokens, ZipTokens
-        self.occurs = dok_matrix((ZipTokens.token_count(),JobTokens.token_count()))
+        self._init_occurs(ZipTokens.token_count(),JobTokens.token_count(),binary=True,max_buffer=max_buffer)
         self.co_occur()
         
     def co_occur(self):
-        for j_tok, j_id in self.JobTokens.tokens2ids.iteritems():
-            j_zip = self.Jobs[j_tok]['Zip']
+        j_toks, j_ids = zip(*self.JobTokens.tokens2ids.iteritems()) or ((),())
+        j_zips = self.Jobs.fields_of('Zip', j_toks, missing=None)
+        for j_zip, j_id in izip(j_zips.tolist(), j_ids):
             if j_zip is not None:
                 try:
-                    self.occurs[self.ZipTokens.token2id(j_zip),j_id] = 1.0
+                    self.accumulator.add(self.ZipTokens.token2id(j_zip),j_id)
                 except KeyError:
                     continue
                 
 class TitleJobOccurs(Occurs):
     '''co-occur job titles with job ids'''
     
-    def __init__(self, Jobs, JobTokens, TitleTokens, StringCleaner):
+    def __init__(self, Jobs, JobTokens, TitleTokens, StringCleaner, workers=1, max_buffer=2**24):
         self.Jobs = Jobs
         self.JobTokens, self.TitleTokens = JobTokens, TitleTokens
         self.StringCleaner = StringCleaner
-        self.occurs = dok_matrix((TitleTokens.token_count(),JobTokens.token_count()))
-        self.occur()
+        self._init_occurs(TitleTokens.token_count(),JobTokens.token_count(),max_buffer=max_buffer)
+        self.occur(workers)
     
-    def occur(self):
-        for j_tok, j_ind in self.JobTokens.tokens2ids.iteritems():
-            j_title = self.StringCleaner.clean(self.Jobs[j_tok]['Title'],rem_stopwords=False)
-            for w in j_title.split(' '):
-                try:
-                    w_ind = self.TitleTokens.tokens2ids[w]
-                except KeyError:
-                    continue
-                self.occurs[w_ind,j_ind] += 1.0
+    def occur(self, workers=1):
+        self.occur_sharded('_occur_shard', self.JobTokens.tokens2ids.items(), workers)
+        
+    def _occur_shard(self, items):
+        acc = self.new_accumulator()
+        titles = self.Jobs.fields_of('Title', [j_tok for j_tok, j_ind in items]).tolist()
+        titles = self.StringCleaner.clean_many(titles,rem_stopwords=False)
+        for (j_tok, j_ind), j_title in izip(items, titles):
+            w_inds = Occurs.known_ids(self.TitleTokens,j_title.split(' '))
+            acc.add_many(w_inds,j_ind)
+        return acc.tocsr()
                                  
 class UserAttributeOccurs(Occurs):
     
-    def __init__(self, Users, UserTokens, AttTokens, attr_str):
+    def __init__(self, Users, UserTokens, AttTokens, attr_str, max_buffer=2**24):
         self.Users = Users
         self.UserTokens, self.AttTokens = UserTokens, AttTokens
-        self.occurs = dok_matrix((UserTokens.token_count(),AttTokens.token_count()))
+        self._init_occurs(UserTokens.token_count(),AttTokens.token_count(),binary=True,max_buffer=max_buffer)
         self.co_occur(attr_str)
         
     def co_occur(self, attr_str):
-        for u_tok, u_id in self.UserTokens.tokens2ids.iteritems():
-            u_attr = self.Users[u_tok][attr_str]
+        u_toks, u_ids = zip(*self.UserTokens.tokens2ids.iteritems()) or ((),())
+        u_attrs = self.Users.fields_of(attr_str, u_toks, missing=None)
+        for u_attr, u_id in izip(u_attrs.tolist(), u_ids):
             if u_attr is not None:
                 try:
-                    self.occurs[u_id,self.AttTokens.token2id(u_attr)] = 1.0
+                    self.accumulator.add(u_id,self.AttTokens.token2id(u_attr))
                 except KeyError:
                     continue
               
                 
 class UserMajorOccurs(Occurs):
     
-    def __init__(self, Users, UserTokens, MajorTokens, StringCleaner):
+    def __init__(self, Users, UserTokens, MajorTokens, StringCleaner, workers=1, max_buffer=2**24):
         self.Users = Users
         self.UserTokens, self.MajorTokens = UserTokens, MajorTokens
         self.StringCleaner = StringCleaner
-        self.occurs = dok_matrix((UserTokens.token_count(),MajorTokens.token_count()))
-        self.occur()
+        self._init_occurs(UserTokens.token_count(),MajorTokens.token_count(),max_buffer=max_buffer)
+        self.occur(workers)
         
-    def occur(self):
-        for u_tok, u_ind in self.UserTokens.tokens2ids.iteritems():
-            u_major = self.StringCleaner.clean(self.Users[u_tok]['Major'],rem_stopwords=False)
-            for w in u_major.split(' '):
-                try:
-                    w_ind = self.MajorTokens.token2id(w)
-                except KeyError:
-                    continue
-                self.occurs[u_ind,w_ind] += 1
+    def occur(self, workers=1):
+        self.occur_sharded('_occur_shard', self.UserTokens.tokens2ids.items(), workers)
+        
+    def _occur_shard(self, items):
+        acc = self.new_accumulator()
+        majors = self.Users.fields_of('Major', [u_tok for u_tok, u_ind in items]).tolist()
+        majors = self.StringCleaner.clean_many(majors,rem_stopwords=False)
+        for (u_tok, u_ind), u_major in izip(items, majors):
+            w_inds = Occurs.known_ids(self.MajorTokens,u_major.split(' '))
+            acc.add_many(u_ind,w_inds)
+        return acc.tocsr()
              
                 
 class UserTitleAppliedOccurs(Occurs):
     
-    def __init__(self, Jobs, UserTokens, TitleTokens, StringCleaner):
+    def __init__(self, Jobs, UserTokens, TitleTokens, StringCleaner, max_buffer=2**24):
         self.Jobs = Jobs
         self.UserTokens, self.TitleTokens = UserTokens, TitleTokens
         self.StringCleaner = StringCleaner
-        self.occurs = dok_matrix((UserTokens.token_count(),TitleTokens.token_count()))
+        self._init_occurs(UserTokens.token_count(),TitleTokens.token_count(),max_buffer=max_buffer)
         self.occur('/media/kaggle/careerbuilder/data/apps.tsv')
         
-    def occur(self, apps_f):
-        f = open(apps_f)
-        f.readline()
-        for l in f:
-            l = l.strip().split('\t')
-            u_tok, j_tok = int(l[0]), int(l[-1])
-            u_ind = self.UserTokens.token2id(u_tok)
-            j_title = self.Jobs[j_tok]['Title']
-            j_title = self.StringCleaner.clean(j_title,rem_stopwords=False)
-            for w in j_title.split(' '):
-                try:
-                    w_ind = self.TitleTokens.token2id(w)
-                except KeyError:
-                    continue
-                self.occurs[u_ind,w_ind] += 1
+    def occur(self, apps_f, chunk_bytes=2**24):
+        for lines in read_chunks(apps_f, chunk_bytes):
+            u_toks, j_toks = split_columns(lines, [0,-1])
+            u_inds = Occurs.map_tokens(self.UserTokens, u_toks)
+            j_titles = self.Jobs.fields_of('Title', [int(t) for t in j_toks]).tolist()
+            for u_ind, j_title in izip(u_inds, j_titles):
+                j_title = self.StringCleaner.clean(j_title,rem_stopwords=False)
+                w_inds = Occurs.known_ids(self.TitleTokens,j_title.split(' '))
+                self.accumulator.add_many(u_ind,w_inds)
+            self.accumulator.flush()
 
 
 class UserTitleHistoricalOccurs(Occurs):
     
-    def __init__(self, UserTokens, TitleTokens, StringCleaner):
+    def __init__(self, UserTokens, TitleTokens, StringCleaner, max_buffer=2**24):
         self.UserTokens, self.TitleTokens = UserTokens, TitleTokens
         self.StringCleaner = StringCleaner
-        self.occurs = dok_matrix((UserTokens.token_count(),TitleTokens.token_count()))
+        self._init_occurs(UserTokens.token_count(),TitleTokens.token_count(),max_buffer=max_buffer)
         self.occur('/media/kaggle/careerbuilder/data/user_history.tsv')
         
-    def occur(self, apps_f):
-        f = open(apps_f)
-        f.readline()
-        for l in f:
-            l = l.strip().split('\t')
-            if len(l) < 5: continue
-            u_tok, u_title = int(l[0]), l[4]
-            try:
-                u_ind = self.UserTokens.token2id(u_tok)
-            except KeyError:
-                continue
-            u_title = self.StringCleaner.clean(u_title,rem_stopwords=False)
-            for w in u_title.split(' '):
+    def occur(self, apps_f, chunk_bytes=2**24):
+        for lines in read_chunks(apps_f, chunk_bytes):
+            for l in lines:
+                l = l.strip().split('\t')
+                if len(l) < 5: continue
+                u_tok, u_title = int(l[0]), l[4]
                 try:
-                    w_ind = self.TitleTokens.token2id(w)
+                    u_ind = self.UserTokens.token2id(u_tok)
                 except KeyError:
                     continue
-                self.occurs[u_ind,w_ind] += 1
+                u_title = self.StringCleaner.clean(u_title,rem_stopwords=False)
+                w_inds = Occurs.known_ids(self.TitleTokens,u_title.split(' '))
+                self.accumulator.add_many(u_ind,w_inds)
+            self.accumulator.flush()
            
                 
 class UserWindowOccurs(Occurs):
     
-    def __init__(self, Users, UserTokens, WindowTokens):
+    def __init__(self, Users, UserTokens, WindowTokens, max_buffer=2**24):
         self.Users = Users
         self.UserTokens, self.WindowTokens = UserTokens, WindowTokens
-        self.occurs = dok_matrix((UserTokens.token_count(),WindowTokens.token_count()))
+        self._init_occurs(UserTokens.token_count(),WindowTokens.token_count(),binary=True,max_buffer=max_buffer)
         self.co_occur()
         
     def co_occur(self):
-        for u_tok, u_id in self.UserTokens.tokens2ids.iteritems():
-            u_win = self.Users[u_tok]['WindowID']
-            self.occurs[u_id,self.WindowTokens.token2id(u_win)] = 1.0
+        u_toks, u_ids = zip(*self.UserTokens.tokens2ids.iteritems()) or ((),())
+        u_wins = self.Users.fields_of('WindowID', u_toks, missing=None)
+        for u_win, u_id in izip(u_wins.tolist(), u_ids):
+            self.accumulator.add(u_id,self.WindowTokens.token2id(u_win))
 
 
 class UserZipOccurs(Occurs):
     
-    def __init__(self, Users, UserTokens, ZipTokens):
+    def __init__(self, Users, UserTokens, ZipTokens, max_buffer=2**24):
         self.Users = Users
         self.UserTokens, self.ZipTokens = UserTokens, ZipTokens
-        self.occurs = dok_matrix((UserTokens.token_count(),ZipTokens.token_count()))
+        self._init_occurs(UserTokens.token_count(),ZipTokens.token_count(),binary=True,max_buffer=max_buffer)
         self.co_occur()
         
     def co_occur(self):
-        for u_tok, u_id in self.UserTokens.tokens2ids.iteritems():
-            u_zip = self.Users[u_tok]['Zip']
+        u_toks, u_ids = zip(*self.UserTokens.tokens2ids.iteritems()) or ((),())
+        u_zips = self.Users.fields_of('Zip', u_toks, missing=None)
+        for u_zip, u_id in izip(u_zips.tolist(), u_ids):
             if u_zip is not None:
                 try:
-                    self.occurs[u_id,self.ZipTokens.token2id(u_zip)] = 1.0
+                    self.accumulator.add(u_id,self.ZipTokens.token2id(u_zip))
                 except KeyError:
                     continue
\ No newline at end of file
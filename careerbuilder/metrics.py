@@ -0,0 +1,36 @@
+'''
+Evaluation metric of the competition: mean average precision at k (MAP@k)
+'''
+from pylab import *
+
+def apk(actual, predicted, k=150):
+    '''
+    Average precision at k
+
+    Parameters
+    ----------
+    actual: list or numpy array
+            the relevant items (e.g. jobs a user applied to)
+    predicted: list or numpy array
+               the predicted items, best first
+    k: int
+       number of predictions considered
+
+    Returns
+    -------
+    float
+    '''
+    actual = set(actual)
+    if not actual:
+        return 0.0
+    score, hits, seen = 0.0, 0, set()
+    for i, p in enumerate(list(predicted)[:k]):
+        if p in actual and p not in seen:
+            hits += 1
+            score += hits / (i + 1.0)
+        seen.add(p)
+    return score / min(len(actual), k)
+
+def mapk(actual, predicted, k=150):
+    '''mean of apk over lists of actual and predicted items'''
+    return mean([apk(a, p, k) for a, p in zip(actual, predicted)])
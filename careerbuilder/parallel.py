@@ -0,0 +1,105 @@
+'''
+Helpers for spreading work over a pool of worker processes.
+
+The object doing the work is handed to the workers by forking, not by
+pickling, so it can hold large data (Users, Jobs, tokens, matrices) without
+pushing it through a pipe.  Only the arguments and results are pickled.
+'''
+import os
+from multiprocessing import Pool
+
+_owner = None
+
+def _call_owner(args):
+    method, arg = args
+    return getattr(_owner, method)(arg)
+
+def fork_map(owner, method, args, workers):
+    '''
+    Calls owner.method(arg) for every arg in args over a pool of worker
+    processes
+
+    Parameters
+    ----------
+    owner: object
+           the object whose method is called, inherited by the workers
+    method: str
+            name of the method to call
+    args: list
+          one argument per call
+    workers: int
+             number of worker processes
+
+    Returns
+    -------
+    list - the results, in the order of args
+    '''
+    global _owner
+    _owner = owner
+    pool = Pool(workers)
+    try:
+        return pool.map(_call_owner, [(method, a) for a in args], chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+        _owner = None
+
+def fork_imap(owner, method, args, workers):
+    '''
+    Like fork_map, but yields the results as they finish (in any order), so
+    the caller can write them out while the rest are still being computed.
+    With workers <= 1 the calls run in this process.
+    '''
+    global _owner
+    if workers <= 1:
+        for a in args:
+            yield getattr(owner, method)(a)
+        return
+    _owner = owner
+    pool = Pool(workers)
+    try:
+        for result in pool.imap_unordered(_call_owner, [(method, a) for a in args]):
+            yield result
+    finally:
+        pool.terminate()
+        pool.join()
+        _owner = None
+
+def shard(items, n_shards):
+    '''split the list items into n_shards contiguous shards of near equal size'''
+    n_shards = max(1, min(n_shards, len(items)))
+    bounds = [len(items) * i // n_shards for i in range(n_shards + 1)]
+    return [items[bounds[i]:bounds[i+1]] for i in range(n_shards)]
+
+def byte_ranges(f_name, n, header=True):
+    '''
+    Splits the body of f_name (after the header line, if header) into n
+    byte ranges [start, end) of near equal size, for read_range
+    '''
+    f = open(f_name, 'rb')
+    if header:
+        f.readline()
+    first = f.tell()
+    f.close()
+    size = os.path.getsize(f_name)
+    bounds = [first + (size - first) * i // n for i in range(n + 1)]
+    return [(bounds[i], bounds[i+1]) for i in range(n)]
+
+def read_range(f_name, start, end):
+    '''
+    Yields the lines of f_name that start at a byte offset in [start, end),
+    so the ranges from byte_ranges together read every line exactly once
+    '''
+    f = open(f_name, 'rb')
+    pos = 0
+    if start > 0:
+        # finish the line that contains byte start-1
+        f.seek(start - 1)
+        pos = start - 1 + len(f.readline())
+    while pos < end:
+        l = f.readline()
+        if not l:
+            break
+        yield l
+        pos += len(l)
+    f.close()
@@ -1,47 +1,301 @@
+import os
+import time
+import hashlib
+from itertools import izip
+from collections import OrderedDict
 from generalized_occurs import Occurs
 from tokens import Tokens
 from things_loaders import *
 from filters import *
 from zips import Zips
+from similarity import UserJobSimilarity
+from parallel import fork_imap
 from pylab import *
 
+class WindowCandidates(object):
+    
+    def __init__(self, inds, JobsMat, JobDistFilt, copy_rows=False):
+        '''
+        The jobs of one window, with what scoring and distance filtering
+        them needs, built once and shared by all the window's users
+
+        inds: the window's job indices
+        copy_rows: if true and JobsMat is in memory, keep a contiguous copy
+                   of the window's job factors (rows) so they are scored
+                   without a gather; a memory-mapped JobsMat is never copied,
+                   so forked workers keep sharing it through the page cache
+        '''
+        self.inds = unique(inds)
+        self.rows = None
+        if copy_rows and not isinstance(JobsMat, memmap):
+            self.rows = ascontiguousarray(JobsMat[self.inds,:])
+        # spatial index over just the window's jobs
+        self.geo_index = JobDistFilt.subset_index(self.inds)
+    
+    def mask(self, exclude):
+        '''boolean mask over inds, False for the jobs in exclude'''
+        keep = ones(len(self.inds), dtype=bool)
+        if len(self.inds) and len(exclude):
+            pos = searchsorted(self.inds, exclude).clip(0, len(self.inds)-1)
+            keep[pos[self.inds[pos] == exclude]] = False
+        return keep
+
 class Recommender(object):
     
     def __init__(self, UsersMat, JobsMat, Users, Jobs, UserTokens, JobTokens, Zips,
                  wind_dates_f = '/media/kaggle/careerbuilder/data/window_dates.tsv',
-                 user_job_occurs_f = '/media/kaggle/careerbuilder/occurs_mm/user_job_train_occurs.mtx'):
+                 user_job_occurs_f = '/media/kaggle/careerbuilder/occurs_mm/user_job_train_occurs.mtx',
+                 geo_dir = None, wind_inds_f = None, JobsANN = None, cand_cache_size = 8,
+                 copy_rows = False):
         self.UsersMat, self.JobsMat = UsersMat, JobsMat
         self.Users, self.Jobs = Users, Jobs
         self.UserTokens, self.JobTokens = UserTokens, JobTokens
         self.Zips = Zips
         self.JobsAppFilt = JobsAppliedFilter(user_job_occurs_f)
-        self.JobWindInds = WindowIndices(wind_dates_f, Jobs, JobTokens)
-        self.JobDistFilt = JobDistanceFilter(Users,Jobs,JobTokens,Zips)
+        self.JobWindInds = WindowIndices(wind_dates_f, Jobs, JobTokens, wind_inds_f)
+        self.JobDistFilt = JobDistanceFilter(Users,Jobs,JobTokens,Zips,UserTokens,geo_dir)
+        # optional approximate index over JobsMat (see ann.WindowANN)
+        self.JobsANN = JobsANN
+        # LRU cache of WindowCandidates, by WindowID
+        self.cand_cache_size = cand_cache_size
+        # if the cached candidates keep a copy of their rows of JobsMat
+        self.copy_rows = copy_rows
+        self.clear_cache()
       
-    def recommend(self, u_ind, k, max_dist=30):
+    def recommend(self, u_ind, k, max_dist=30, top_n=None, n_probe=None):
         '''
         k: number of predictions to make
+        top_n: if given, only the top_n most similar candidates are ordered
+               and passed on to the distance filter, otherwise all of them
+        n_probe: cells probed in JobsANN, if the recommender has one
         
         returns a list of indices corresponding to columns
         in the user-job co-occur matrix
         '''
         u_vec = self.UsersMat[u_ind,:]
         u_tok = self.UserTokens.id2token(u_ind)
-        cnd_inds = self.job_candidates(u_tok)
-        job_inds,sims = Recommender.order_similarity(self.JobsMat,u_vec,array(cnd_inds))
-        return self.filter(u_tok, job_inds, max_dist, k)
+        w_id = self.Users.field(u_tok,'WindowID')
+        cands = self.window_candidates(w_id)
+        appd = self.JobsAppFilt.applied(u_ind)
+        if self.JobsANN is not None:
+            job_inds,sims = self.JobsANN.query(w_id,u_vec,top_n,n_probe,exclude=appd)
+        else:
+            keep = cands.mask(appd)
+            if cands.rows is not None:
+                sims = dot(cands.rows,u_vec)[keep]
+            else:
+                sims = dot(self.JobsMat[cands.inds[keep],:],u_vec)
+            job_inds,sims = UserJobSimilarity.top_k(sims,cands.inds[keep],top_n)
+        return self.filter(u_tok, job_inds, max_dist, k, cands)
     
+    def recommend_all(self, user_indices, k, out_f, workers=1, max_dist=30, top_n=None,
+                      n_probe=None, batch_size=1000, checkpoint_f=None, mem_budget=2**27):
+        '''
+        Recommends k jobs to each user and streams them to a submission file
+
+        Users are grouped by WindowID into batches that a pool of forked
+        workers recommend for.  The workers inherit this recommender, so
+        matrices, occurrences and geocodes that are memory-mapped (see
+        UserJobSimilarity.from_binary, JobsAppliedFilter, geo_dir) are shared
+        through the page cache rather than copied.
+
+        Parameters
+        ----------
+        user_indices: list of ints
+                      the users to recommend for
+        k: int
+           number of jobs per user
+        out_f: str
+               the submission file, lines of UserID<tab>space separated JobIDs
+        workers: int
+                 number of worker processes
+        max_dist, top_n, n_probe: see recommend; with top_n (and no JobsANN)
+                 each batch is scored with rank_many
+        batch_size: int
+                    most users per batch
+        checkpoint_f: str, optional
+                      file the finished batches are logged to, defaults to
+                      out_f + '.ckpt'.  If it exists, the run resumes after
+                      the batches it lists; it must be from a run with the
+                      same users, k, batch_size, max_dist, top_n and n_probe
+                      (see run_key), otherwise an Exception is raised.
+        '''
+        if checkpoint_f is None:
+            checkpoint_f = out_f + '.ckpt'
+        batches = self.window_batches(user_indices, batch_size)
+        key = Recommender.run_key(user_indices, k, batch_size, max_dist, top_n, n_probe)
+        ckpt_key, done, offset = Recommender.read_checkpoint(checkpoint_f)
+        if done and os.path.exists(out_f):
+            if ckpt_key != key:
+                raise Exception('checkpoint %s is from a run with other users or parameters, '
+                                'delete it to start over' % checkpoint_f)
+            out = open(out_f, 'r+b')
+            # drop anything written after the last finished batch
+            out.truncate(offset)
+            out.seek(offset)
+            print 'resuming: %d of %d batches already done' % (len(done), len(batches))
+        else:
+            done = set()
+            out = open(out_f, 'wb')
+            out.write('UserID\tJobIDs\n')
+            f = open(checkpoint_f, 'w')
+            f.write('#%s\n' % key)
+            f.close()
+        ckpt = open(checkpoint_f, 'a')
+        todo = [(b_id, u_inds, k, max_dist, top_n, n_probe, mem_budget)
+                for b_id, u_inds in enumerate(batches) if b_id not in done]
+        n_users = sum(len(t[1]) for t in todo)
+        finished, start = 0, time.time()
+        try:
+            for b_id, lines in fork_imap(self, '_recommend_batch', todo, workers):
+                out.writelines(lines)
+                out.flush()
+                os.fsync(out.fileno())
+                ckpt.write('%d\t%d\n' % (b_id, out.tell()))
+                ckpt.flush()
+                finished += len(lines)
+                secs = max(time.time() - start, 1e-6)
+                print '%d/%d users, %.1f users/s, %.0fs left' % (finished, n_users, finished/secs,
+                                                                (n_users - finished)*secs/finished)
+        finally:
+            out.close()
+            ckpt.close()
+    
+    def window_batches(self, user_indices, batch_size):
+        '''splits users (by index) into batches of at most batch_size users from one window'''
+        u_inds = asarray(user_indices)
+        windows = self.user_windows(u_inds)
+        order = argsort(windows, kind='mergesort')
+        batches = []
+        for w in unique(windows):
+            w_inds = u_inds[order][windows[order] == w]
+            batches.extend(w_inds[i:i+batch_size] for i in xrange(0, len(w_inds), batch_size))
+        return batches
+    
+    def user_windows(self, u_inds):
+        '''the WindowID of each of many users (by index), as a numpy array'''
+        u_toks = self.UserTokens.ids2tokens_bulk(asarray(u_inds, dtype=int))[0]
+        return self.Users.fields_of('WindowID', u_toks)
+    
+    @staticmethod
+    def run_key(user_indices, k, batch_size, max_dist, top_n, n_probe):
+        '''md5 of the arguments of recommend_all that decide its batches and output'''
+        md5 = hashlib.md5()
+        md5.update(asarray(user_indices, dtype=int64).tostring())
+        md5.update(repr((k, batch_size, max_dist, top_n, n_probe)))
+        return md5.hexdigest()
+    
+    @staticmethod
+    def read_checkpoint(checkpoint_f):
+        '''
+        Returns
+        -------
+        (run key of the checkpoint or None, set of finished batch ids, size
+        of the output file after the last of them)
+        '''
+        key, done, offset = None, set(), 0
+        if os.path.exists(checkpoint_f):
+            for l in open(checkpoint_f):
+                if l.startswith('#') and l.endswith('\n'):
+                    key = l[1:].strip()
+                    continue
+                l = l.split('\t')
+                if len(l) == 2 and l[1].endswith('\n'):
+                    done.add(int(l[0]))
+                    offset = int(l[1])
+        return key, done, offset
+    
+    def _recommend_batch(self, args):
+        '''recommends for one batch of recommend_all, returns (batch id, submission lines)'''
+        b_id, u_inds, k, max_dist, top_n, n_probe, mem_budget = args
+        if top_n is not None and self.JobsANN is None:
+            ranked, _ = self.rank_many(u_inds, top_n, mem_budget)
+            preds = []
+            for u, inds in izip(u_inds, ranked):
+                u_tok = self.UserTokens.id2token(u)
+                cands = self.window_candidates(self.Users.field(u_tok,'WindowID'))
+                preds.append(self.filter(u_tok, inds, max_dist, k, cands))
+        else:
+            preds = [self.recommend(u, k, max_dist, top_n, n_probe) for u in u_inds]
+        lines = []
+        for u, pred in izip(u_inds, preds):
+            jobs = self.JobTokens.ids2tokens_bulk(asarray(pred, dtype=int))[0]
+            lines.append('%s\t%s\n' % (self.UserTokens.id2token(u), ' '.join(str(j) for j in jobs)))
+        return b_id, lines
+      
     def job_candidates(self, u_tok):
         '''
         return a list of valid jobs a user could be recommended
         '''
-        job_inds = self.JobWindInds[self.Users[u_tok]['WindowID']]
-        return self.JobsAppFilt.filter(self.UserTokens.token2id(u_tok),job_inds)
+        cands = self.window_candidates(self.Users.field(u_tok,'WindowID'))
+        appd = self.JobsAppFilt.applied(self.UserTokens.token2id(u_tok))
+        return cands.inds[cands.mask(appd)]
+    
+    def window_candidates(self, w_id):
+        '''the WindowCandidates of window w_id, from the cache if it was built before'''
+        try:
+            cands = self.cand_cache.pop(w_id)
+            self.hits += 1
+        except KeyError:
+            cands = WindowCandidates(self.JobWindInds[w_id], self.JobsMat, self.JobDistFilt,
+                                     self.copy_rows)
+            self.misses += 1
+            if len(self.cand_cache) >= self.cand_cache_size:
+                self.cand_cache.popitem(last=False)
+        self.cand_cache[w_id] = cands
+        return cands
+    
+    def clear_cache(self):
+        '''empty the window candidate cache and reset its counters (e.g. after changing JobsMat)'''
+        self.cand_cache = OrderedDict()
+        self.hits, self.misses = 0, 0
+    
+    def cache_info(self):
+        lookups = self.hits + self.misses
+        return {'hits':self.hits, 'misses':self.misses, 'size':len(self.cand_cache),
+                'max_size':self.cand_cache_size,
+                'hit_rate':self.hits / float(lookups) if lookups else 0.0}
       
-    def filter(self, u_tok, pred_inds, max_dist, k):
-        '''filter a list of predictions preds, return the best k of them'''
-        
-        filt_inds = self.JobDistFilt.filter(u_tok,pred_inds,max_dist)
+    def job_candidates_many(self, u_inds):
+        '''
+        return the valid jobs for each of many users (by index), as a list
+        of arrays, with one call to the applied filter
+        '''
+        windows = self.user_windows(u_inds).tolist()
+        job_inds = dict((w,self.JobWindInds[w]) for w in set(windows))
+        return self.JobsAppFilt.filter_many(u_inds,job_inds,windows)
+      
+    def rank_many(self, u_inds, k, mem_budget=2**27):
+        '''
+        the k most similar valid jobs for each of many users (by index); the
+        users of a window are scored together, a block at a time, with one
+        matrix-matrix multiply (see UserJobSimilarity.block_topk)
+
+        returns lists of job index arrays and similarity arrays, in the
+        order of u_inds
+        '''
+        u_inds = asarray(u_inds)
+        windows = self.user_windows(u_inds)
+        inds, sims = [None]*len(u_inds), [None]*len(u_inds)
+        for w in unique(windows):
+            pos = nonzero(windows == w)[0]
+            appd = [self.JobsAppFilt.applied(u) for u in u_inds[pos]]
+            cands = self.window_candidates(w)
+            w_inds, w_sims = UserJobSimilarity.block_topk(self.UsersMat, self.JobsMat, u_inds[pos],
+                                                          cands.inds, k, mem_budget, appd, cands.rows)
+            for p, i, s in izip(pos, w_inds, w_sims):
+                inds[p], sims[p] = i, s
+        return inds, sims
+      
+    def filter(self, u_tok, pred_inds, max_dist, k, cands=None):
+        '''
+        filter a list of predictions preds, return the best k of them
+
+        cands: the WindowCandidates the predictions came from, whose spatial
+               index is searched instead of the one over all jobs
+        '''
+        index = cands.geo_index if cands is not None else None
+        filt_inds = self.JobDistFilt.filter(u_tok,pred_inds,max_dist,index=index)
         if len(filt_inds) >= k:
             filtered = filt_inds[0:k]
         elif len(filt_inds) > 0 and len(filt_inds) < k:
@@ -53,12 +307,13 @@ class Recommender(object):
         return filtered
     
     @staticmethod
-    def order_similarity(mat, vec, inds):
+    def order_similarity(mat, vec, inds, k=None):
         '''
         return a list of similarity values and their indices in the SimSpace
 
         inds: is an array of indices that correspond to a subset of rows of mat
+        k: if given, only the k most similar are returned, selected without
+           sorting all of inds
         '''
-        sims = dot(mat,vec)[inds,:]
-        sort_index = np.argsort(sims)[::-1] #descend order
-        return inds[sort_index],sims[sort_index]
\ No newline at end of file
+        sims = dot(mat[inds,:],vec)
+        return UserJobSimilarity.top_k(sims,inds,k)
\ No newline at end of file
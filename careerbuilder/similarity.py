@@ -1,17 +1,104 @@
+import os
 import sys
-execfile('/media/lib/python/set_paths.py')
+import time
+if os.path.exists('/media/lib/python/set_paths.py'):
+    execfile('/media/lib/python/set_paths.py')
 sys.path.append('/media/git/wordsim/src/')
 from scipy.io import mmread
 from pylab import *
+from metrics import mapk
 
 class UserJobSimilarity(object):
     
+    precisions = ('float64', 'float32', 'int8')
+    precision = 'float64'
+    # int8 quantized J and its per-row scales, only in 'int8' precision
+    Jq, J_scale = None, None
+    # with Jq, the first pass keeps rescore*k jobs for exact rescoring
+    rescore = 4
+    
     def __init__(self, mat_dir, sval_name = 'stitched_occurs.mtx.singular_values',
-                 svec_prefix = 'stitched_occurs.mtx', n_svs=200, norm=True):
+                 svec_prefix = 'stitched_occurs.mtx', n_svs=200, norm=True,
+                 precision='float64'):
         self.U, self.J = self.load_mats(mat_dir, sval_name, svec_prefix, n_svs)
         if norm:
             self.U = UserJobSimilarity._norm_mat(self.U)
             self.J = UserJobSimilarity._norm_mat(self.J)
+        self.set_precision(precision)
+    
+    def set_precision(self, precision, rescore=4, J_file=None):
+        '''
+        Sets the precision similarity is computed in
+
+        Parameters
+        ----------
+        precision: str
+                   'float64', 'float32' (U and J in float32), or 'int8'
+                   (float32, plus an int8 copy of J with a scale per row that
+                   top-k searches score first, rescoring the best rescore*k
+                   jobs exactly in float32)
+        rescore: int
+                 short list size, as a multiple of k, for 'int8'
+        J_file: str, optional
+                for 'int8', the float32 J is saved to this .npy file and
+                reopened memory-mapped, so only the rows gathered for
+                rescoring are paged in (from_binary does the same)
+        '''
+        if precision not in UserJobSimilarity.precisions:
+            raise Exception('unknown precision %s, expected one of %s' % (precision, UserJobSimilarity.precisions))
+        f_type = float64 if precision == 'float64' else float32
+        if self.U.dtype != f_type:
+            self.U = self.U.astype(f_type)
+        if self.J.dtype != f_type:
+            self.J = self.J.astype(f_type)
+        self.Jq, self.J_scale = None, None
+        if precision == 'int8':
+            self.Jq, self.J_scale = UserJobSimilarity.quantize_rows(self.J)
+            if J_file is not None:
+                save(J_file, self.J)
+                self.J = load(J_file, mmap_mode='r')
+        self.precision, self.rescore = precision, rescore
+    
+    def with_precision(self, precision, rescore=4, J_file=None):
+        '''a copy in another precision, sharing arrays where they don't change'''
+        sim = UserJobSimilarity.__new__(UserJobSimilarity)
+        sim.__dict__.update(self.__dict__)
+        sim.set_precision(precision, rescore, J_file)
+        return sim
+    
+    @staticmethod
+    def quantize_rows(mat, block=2**16):
+        '''
+        int8 quantization of each row of mat, scaled by its largest magnitude
+
+        Returns
+        -------
+        (q, scale) - int8 matrix and float32 per-row scales, mat ~ q * scale[:,None]
+        '''
+        q = empty(mat.shape, dtype=int8)
+        scale = empty(mat.shape[0], dtype=float32)
+        for start in xrange(0, mat.shape[0], block):
+            rows = asarray(mat[start:start+block,:], dtype=float32)
+            s = abs(rows).max(axis=1) / 127.
+            s[s == 0] = 1.
+            q[start:start+block,:] = rint(rows / s[:,None])
+            scale[start:start+block] = s
+        return q, scale
+    
+    @staticmethod
+    def scores(U_rows, J_rows, J_scale=None, block=2**12):
+        '''
+        dot(U_rows, J_rows.T); if J_scale is given, J_rows are int8 rows
+        with those scales (see quantize_rows), converted to floats block
+        rows at a time so the dequantized rows are never all in memory
+        '''
+        if J_scale is None:
+            return dot(U_rows, J_rows.T)
+        S = empty((U_rows.shape[0], J_rows.shape[0]), dtype=U_rows.dtype)
+        for start in xrange(0, J_rows.shape[0], block):
+            S[:,start:start+block] = dot(U_rows, J_rows[start:start+block,:].T.astype(U_rows.dtype))
+        S *= J_scale
+        return S
         
     def load_mats(self, mat_dir, sval_name, svec_prefix, n_svs):
         '''
@@ -37,23 +124,69 @@ class UserJobSimilarity(object):
         UsersMat, JobsMat -- numpy arrays
         '''
         # load singular values
-        D = mmread(mat_dir+sval_name)[0:n_svs]
-        D = diag(D[:,0])
+        D = mmread(mat_dir+sval_name)[0:n_svs,0]
         
         # load SVD output matrices
         def load_eigenmat(name_prefix,num):
-            eigenvectors = []
+            # fill one preallocated matrix rather than hstack-ing copies
+            mat = None
             for i in range(num):
-                eigenvectors.append(mmread(name_prefix+str(i)))
-            return hstack(eigenvectors)
+                vec = mmread(name_prefix+str(i))
+                if mat is None:
+                    mat = empty((vec.shape[0],num))
+                mat[:,i] = vec[:,0]
+            return mat
             
         U = load_eigenmat(mat_dir+svec_prefix+'.U.',n_svs)
         V = load_eigenmat(mat_dir+svec_prefix+'.V.',n_svs).T
-        UsersMat, JobsMat = dot(V.T,D), dot(D,U.T).T
+        # scale the columns by the singular values, same as multiplying by diag(D)
+        UsersMat, JobsMat = V.T * D, U * D
         del U, V, D
         
         return UsersMat, JobsMat
     
+    def save_binary(self, out_dir):
+        '''
+        Saves the (scaled and normalized) user and job matrices as
+        out_dir/users.npy and out_dir/jobs.npy, in the current precision, so
+        they can be opened memory-mapped with from_binary instead of
+        re-reading the SVD output. In 'int8' precision the quantized jobs are
+        saved too, as jobs_q.npy and jobs_scale.npy.
+        '''
+        if not os.path.exists(out_dir):
+            os.makedirs(out_dir)
+        save(os.path.join(out_dir,'users.npy'), ascontiguousarray(self.U))
+        save(os.path.join(out_dir,'jobs.npy'), ascontiguousarray(self.J))
+        if self.Jq is not None:
+            save(os.path.join(out_dir,'jobs_q.npy'), self.Jq)
+            save(os.path.join(out_dir,'jobs_scale.npy'), self.J_scale)
+    
+    @staticmethod
+    def from_binary(in_dir, mmap_mode='r', precision=None):
+        '''
+        Opens matrices written by save_binary. With mmap_mode set, the arrays
+        are memory-mapped, so processes opening the same files share one copy
+        in the page cache.
+
+        precision: if given and not the precision saved, the matrices are
+                   converted in memory (see set_precision)
+
+        Returns
+        -------
+        UserJobSimilarity instance
+        '''
+        sim = UserJobSimilarity.__new__(UserJobSimilarity)
+        sim.U = load(os.path.join(in_dir,'users.npy'), mmap_mode=mmap_mode)
+        sim.J = load(os.path.join(in_dir,'jobs.npy'), mmap_mode=mmap_mode)
+        sim.precision = 'float64' if sim.J.dtype == float64 else 'float32'
+        if os.path.exists(os.path.join(in_dir,'jobs_q.npy')):
+            sim.Jq = load(os.path.join(in_dir,'jobs_q.npy'), mmap_mode=mmap_mode)
+            sim.J_scale = load(os.path.join(in_dir,'jobs_scale.npy'))
+            sim.precision = 'int8'
+        if precision is not None and precision != sim.precision:
+            sim.set_precision(precision)
+        return sim
+    
     def user_jobs_sim(self, u_ind, j_inds, ordered=False):
         '''
         Computes similarity between a user and jobs
@@ -72,16 +205,185 @@ class UserJobSimilarity(object):
         -------
         sims - numpy array; optionally: (inds, sims) [ordered]
         '''
-        sims = dot(self.J,self.U[u_ind,:])[j_inds,:]
+        j_inds = asarray(j_inds)
+        sims = dot(self.J[j_inds,:],self.U[u_ind,:])
         if ordered:
             return UserJobSimilarity.order_similarity(sims,j_inds)
         else:
             return sims
     
+    def user_jobs_topk(self, u_ind, j_inds, k, full_sort=False):
+        '''
+        Finds the k jobs most similar to a user, only multiplying the rows
+        of the candidate jobs
+
+        Parameters
+        ----------
+        u_ind: int
+               the user index in the User matrix
+        j_inds: list or numpy array
+                candidate job indices
+        k: int
+           number of jobs to return
+        full_sort: boolean, default=False
+                   if true, orders every candidate and keeps the first k
+                   instead of partially selecting the top k
+
+        Returns
+        -------
+        (inds, sims) - numpy arrays of the top k job indices and their
+                       similarity, from highest to lowest
+        '''
+        j_inds = asarray(j_inds)
+        if self.Jq is not None and not full_sort:
+            # first pass on the int8 jobs, exact rescoring of the short list
+            approx = UserJobSimilarity.scores(self.U[u_ind:u_ind+1,:], self.Jq[j_inds,:],
+                                              self.J_scale[j_inds])[0]
+            j_inds = UserJobSimilarity.top_k(approx,j_inds,self.rescore*k)[0]
+        sims = dot(self.J[j_inds,:],self.U[u_ind,:])
+        if full_sort:
+            inds, sims = UserJobSimilarity.order_similarity(sims,j_inds)
+            return inds[:k], sims[:k]
+        return UserJobSimilarity.top_k(sims,j_inds,k)
+    
+    def users_jobs_topk(self, u_inds, j_inds, k, mem_budget=2**27, exclude=None):
+        '''
+        Finds the k jobs most similar to each of a block of users, scoring
+        them against shared candidate jobs with one matrix-matrix multiply
+        per block of users (see block_topk)
+
+        Parameters
+        ----------
+        u_inds: list or numpy array
+                user indices in the User matrix
+        j_inds: list or numpy array
+                candidate job indices, shared by all users (e.g. a window)
+        k: int
+           number of jobs to return per user
+        mem_budget: int
+                    bytes the score matrix of a block may take up, which sets
+                    how many users are scored per multiply
+        exclude: list of arrays, optional
+                 per user, job indices not to return (e.g. applied jobs)
+
+        Returns
+        -------
+        (inds, sims) - lists with, for each user, numpy arrays of the top k
+                       job indices and their similarity, highest first
+        '''
+        if self.Jq is None:
+            return UserJobSimilarity.block_topk(self.U, self.J, u_inds, j_inds, k,
+                                                mem_budget, exclude)
+        # first pass on the int8 rows of the candidates, then exact
+        # rescoring of each user's short list
+        short, _ = UserJobSimilarity.block_topk(self.U, self.Jq, u_inds, j_inds, self.rescore*k,
+                                                mem_budget, exclude, J_scale=self.J_scale)
+        inds, sims = [], []
+        for u_ind, s_inds in zip(u_inds, short):
+            i, s = UserJobSimilarity.top_k(dot(self.J[s_inds,:],self.U[u_ind,:]), s_inds, k)
+            inds.append(i)
+            sims.append(s)
+        return inds, sims
+    
+    @staticmethod
+    def block_topk(U, J, u_inds, j_inds, k, mem_budget=2**27, exclude=None, J_rows=None,
+                   J_scale=None):
+        '''
+        Top k rows of J for each of the rows u_inds of U, among rows j_inds.
+
+        The candidate rows of J are gathered once, then users are scored in
+        blocks as dot(U[block], J[j_inds].T), a single BLAS GEMM that runs
+        on as many threads as the BLAS library is given (OMP_NUM_THREADS /
+        OPENBLAS_NUM_THREADS / MKL_NUM_THREADS).  Blocks hold as many users
+        as fit in mem_budget bytes, counting the scores and the partition
+        indices of the block. J_rows, if given, are the already gathered
+        candidate rows J[j_inds] (J is then not used).  J_scale, if given,
+        are the per-row scales of an int8 J, whose rows are scored without
+        dequantizing them all (see scores).
+        '''
+        u_inds, j_inds = asarray(u_inds), asarray(j_inds)
+        n_c = len(j_inds)
+        inds, sims = [], []
+        if n_c == 0 or k <= 0:
+            empty = zeros(0, dtype=j_inds.dtype), zeros(0, dtype=U.dtype)
+            return [empty[0]]*len(u_inds), [empty[1]]*len(u_inds)
+        Jc = J[j_inds,:] if J_rows is None else J_rows
+        Jc_scale = None if J_scale is None else J_scale[j_inds]
+        k = min(k, n_c)
+        row_bytes = n_c * (result_type(U, Jc).itemsize + dtype(intp).itemsize)
+        block = int(max(1, mem_budget // row_bytes))
+        for start in xrange(0, len(u_inds), block):
+            b_inds = u_inds[start:start+block]
+            S = UserJobSimilarity.scores(U[b_inds,:], Jc, Jc_scale)
+            if exclude is not None:
+                for r, excl in enumerate(exclude[start:start+block]):
+                    if len(excl):
+                        S[r, in1d(j_inds, excl)] = -inf
+            rows = arange(len(b_inds))[:,None]
+            if k < n_c:
+                top = argpartition(S, n_c - k, axis=1)[:, n_c - k:]
+            else:
+                top = tile(arange(n_c), (len(b_inds), 1))
+            top = top[rows, argsort(S[rows, top], axis=1)[:, ::-1]]
+            top_sims = S[rows, top]
+            for r in xrange(len(b_inds)):
+                keep = top_sims[r] > -inf
+                inds.append(j_inds[top[r][keep]])
+                sims.append(top_sims[r][keep])
+        return inds, sims
+    
+    def precision_report(self, u_inds, j_inds, actual, k=150, precisions=('float32','int8')):
+        '''
+        Prints MAP@k of the top k jobs at each precision next to float64,
+        with the overlap of their top k and the scoring time per user; self
+        should be in float64 for the baseline to be exact
+
+        Parameters
+        ----------
+        u_inds: list of ints
+                user indices
+        j_inds: list of arrays
+                candidate jobs for each user
+        actual: list of arrays
+                relevant jobs for each user (e.g. held out applications)
+
+        Returns
+        -------
+        dict - maps precision to (MAP@k, mean top k overlap with float64)
+        '''
+        report = {}
+        exact = None
+        for precision in ('float64',) + tuple(precisions):
+            sim = self.with_precision(precision)
+            t = time.time()
+            preds = [sim.user_jobs_topk(u, c, k)[0] for u, c in zip(u_inds, j_inds)]
+            secs = (time.time() - t) / max(1, len(u_inds))
+            if exact is None:
+                exact = preds
+            overlap = mean([len(intersect1d(p, e)) / float(max(1, len(e))) for p, e in zip(preds, exact)])
+            report[precision] = (mapk(actual, preds, k), overlap)
+            print '%s: MAP@%d %.5f, top %d overlap %.4f, %.3f ms/user' % (precision, k, report[precision][0],
+                                                                      k, overlap, 1000*secs)
+        return report
+    
     @staticmethod
     def order_similarity(sims, inds):
         sort_index = np.argsort(sims)[::-1] # descending order
         return inds[sort_index],sims[sort_index]
+    
+    @staticmethod
+    def top_k(sims, inds, k):
+        '''
+        the k highest sims and their inds, from highest to lowest, by
+        partitioning around the kth value and only sorting the top k
+        '''
+        if k is None or k >= len(sims):
+            return UserJobSimilarity.order_similarity(sims, inds)
+        if k <= 0:
+            return asarray(inds)[:0], asarray(sims)[:0]
+        top = np.argpartition(sims, len(sims) - k)[len(sims) - k:]
+        top = top[np.argsort(sims[top])[::-1]]
+        return inds[top],sims[top]
 
     @staticmethod
     def _norm_mat(mat, nan_check=True):
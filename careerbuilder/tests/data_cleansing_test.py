@@ -0,0 +1,74 @@
+'''
+Regression test: StringCleaner.clean must give exactly the output of the
+original regex/replace implementation on a random corpus
+'''
+import unittest
+import os
+import re
+import sys
+import random
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from data_cleansing import StringCleaner
+
+STOP_WORDS_F = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'stop_words.txt')
+
+def original_clean(stop_words, s, rem_stopwords=True, badlist=None):
+    '''StringCleaner.clean as it was before stop word removal was tokenized'''
+    s = re.sub(r'[A-Z][A-Z0-9 .\?\,\(\)]{6,}\s+',' ',s) # remove boilerplate
+    s = re.sub("([a-z])([A-Z])","\g<1> \g<2>",s) #split camelCase words
+    s = s.lower()
+    if badlist is not None:
+        for b in badlist:
+            s = s.replace(b,' ')
+    s = re.sub('[^a-zA-Z ]',' ',s)
+    s = re.sub(' [a-z] ', ' ', s) #remove single letters
+    if rem_stopwords:
+        for w in stop_words:
+            w_s = ' %s ' % w
+            if w_s in s:
+                s = s.replace(w_s,' ')
+    s = re.sub(' {2,}',' ',s) # remove extra spaces
+    return s
+
+
+class Test(unittest.TestCase):
+    
+    n_strings = 5000
+    
+    def setUp(self):
+        self.SC = StringCleaner(STOP_WORDS_F)
+        self.rng = random.Random(1)
+        stops = sorted(self.SC.stop_words)
+        self.vocab = stops[:60] + ['Engineer','NURSE PRACTITIONER ','manager','x','a','b',
+                                   'camelCase','R&D','\\r\\n','  ','dev-ops','it','is',
+                                   'the','  the','C++','span','li','<p>','SENIOR ANALYST']
+        
+    kwargs = [dict(), dict(rem_stopwords=False), dict(badlist=['\\r\\n','\\r']),
+              dict(badlist=['span','li'])]
+    
+    def assertSameClean(self, s, kw):
+        self.assertEqual(self.SC.clean(s, **kw), original_clean(self.SC.stop_words, s, **kw),
+                         'mismatch on %r %r' % (s, kw))
+    
+    def test_clean_matches_original(self):
+        for i in xrange(self.n_strings):
+            s = ' '.join(self.rng.choice(self.vocab) for _ in xrange(self.rng.randint(0,25)))
+            self.assertSameClean(s, self.kwargs[i % len(self.kwargs)])
+            
+    def test_edge_cases(self):
+        stop = sorted(self.SC.stop_words)[0]
+        strs = ['', ' ', 'the the the', 'a the a the', 'x %s %s %s x' % (stop, stop, stop),
+                'manager  the  engineer', '   ', 'the', ' the ', 'span li span\\r\\nli',
+                'R&D\\r\\n\\r\\nC++', 'it is   is it', 'NURSE PRACTITIONER  the <p>']
+        for s in strs:
+            for kw in self.kwargs:
+                self.assertSameClean(s, kw)
+            
+    def test_clean_many_matches_clean(self):
+        strs = ['Hello World of the Engineers', 'SENIOR MANAGER NEEDED  now', 'the the the a']
+        self.assertEqual(list(self.SC.clean_many(strs)), [original_clean(self.SC.stop_words, s)
+                                                          for s in strs])
+        
+
+if __name__ == "__main__":
+    unittest.main()
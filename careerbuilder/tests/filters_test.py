@@ -0,0 +1,107 @@
+'''
+Window indices saved to disk and the distance filter
+'''
+import unittest
+import os
+import sys
+import shutil
+import tempfile
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from numpy import array_equal, column_stack
+from numpy.random import RandomState
+from filters import WindowIndices, JobDistanceFilter
+from zips import Zips, GeoCodes
+from things_loaders import Jobs
+from tokens import Tokens
+
+def make_tokens(toks):
+    T = Tokens()
+    T.tokens2ids = dict((t,i) for i,t in enumerate(toks))
+    T.ids2tokens = dict((i,t) for i,t in enumerate(toks))
+    return T
+
+
+class CountingWindowIndices(WindowIndices):
+    '''counts the times the indices are built instead of loaded'''
+    builds = 0
+
+    def wind2ind(self, Thing, Tokens, test_period_only=True):
+        CountingWindowIndices.builds += 1
+        return WindowIndices.wind2ind(self, Thing, Tokens, test_period_only)
+
+
+class WindowIndicesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.dates_f = os.path.join(self.dir, 'window_dates.tsv')
+        f = open(self.dates_f, 'w')
+        f.write('Window\tTrain Start\tTest Start\tTest End\n')
+        for w in (1, 2, 3):
+            f.write('%d\t2012-04-01 00:00:00\t2012-04-%02d 00:00:00\t2012-05-30 00:00:00\n' % (w, 10+w))
+        f.close()
+        self.Jobs = Jobs.__new__(Jobs)
+        self.Jobs.things = dict((j, {'WindowID':j%3+1, 'EndDate':'2012-04-%02d 12:00:00' % (j%20+1)})
+                                for j in range(100))
+        CountingWindowIndices.builds = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_saved_without_suffix(self):
+        inds_f = os.path.join(self.dir, 'wind_inds')
+        T = make_tokens(range(100))
+        W = CountingWindowIndices(self.dates_f, self.Jobs, T, inds_f)
+        self.assertTrue(os.path.exists(inds_f + '.npz'))
+        W2 = CountingWindowIndices(self.dates_f, self.Jobs, T, inds_f)
+        W3 = CountingWindowIndices(self.dates_f, inds_f=inds_f)
+        self.assertEqual(CountingWindowIndices.builds, 1)
+        for w in W.wid_to_jind:
+            self.assertTrue(array_equal(W2[w], W[w]))
+            self.assertTrue(array_equal(W3[w], W[w]))
+
+    def test_rebuilt_for_other_tokens(self):
+        inds_f = os.path.join(self.dir, 'wind_inds.npz')
+        CountingWindowIndices(self.dates_f, self.Jobs, make_tokens(range(100)), inds_f)
+        T = make_tokens(range(99, -1, -1))
+        W = CountingWindowIndices(self.dates_f, self.Jobs, T, inds_f)
+        self.assertEqual(CountingWindowIndices.builds, 2)
+        expected = WindowIndices(self.dates_f, self.Jobs, T)
+        self.assertEqual(sorted(W.wid_to_jind), sorted(expected.wid_to_jind))
+        for w in W.wid_to_jind:
+            self.assertTrue(array_equal(W[w], expected[w]))
+
+
+class JobDistanceFilterTest(unittest.TestCase):
+    '''filtering by max_dist through the spatial index must keep the jobs the distance array keeps'''
+
+    def setUp(self):
+        rs = RandomState(1)
+        n_jobs, n_users = 2000, 100
+        job_latlong = column_stack([rs.uniform(32, 36, n_jobs), rs.uniform(-120, -115, n_jobs)])
+        job_latlong[rs.rand(n_jobs) < 0.1] = 0
+        user_latlong = column_stack([rs.uniform(32, 36, n_users), rs.uniform(-120, -115, n_users)])
+        known = rs.rand(n_users) > 0.1
+        self.F = JobDistanceFilter.__new__(JobDistanceFilter)
+        self.F.Zips, self.F.job_latlong = Zips, job_latlong
+        self.F.UserTokens = make_tokens(range(1000, 1000 + n_users))
+        self.F.user_geo = GeoCodes(user_latlong, known)
+        self.users = range(1000, 1000 + n_users)
+        self.rs = rs
+
+    def test_filter_max_dist(self):
+        for u_tok in self.users:
+            j_inds = self.rs.choice(len(self.F.job_latlong), 500, replace=False)
+            for max_dist in (1, 10, 30, 150):
+                if self.F.user_lat_long(u_tok) is None:
+                    expected = []
+                else:
+                    inds, dists = self.F.filter(u_tok, j_inds, return_dists=True, return_all=True)
+                    expected = list(inds[(dists >= 0) & (dists <= max_dist)])
+                self.assertEqual(self.F.filter(u_tok, j_inds, max_dist), expected)
+                index = self.F.subset_index(j_inds)
+                self.assertEqual(self.F.filter(u_tok, j_inds, max_dist, index=index), expected)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,90 @@
+'''
+Sharded (multi-process) occurrence builds must equal the serial build, and
+both the original dictionary-of-keys counting
+'''
+import unittest
+import os
+import sys
+from random import Random
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from scipy.sparse import dok_matrix
+from generalized_occurs import *
+from data_cleansing import StringCleaner
+from tokens import Tokens
+from things_loaders import ColumnStore, Jobs, Users
+
+STOP_WORDS_F = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'stop_words.txt')
+
+def make_tokens(toks):
+    T = Tokens()
+    T.tokens2ids = dict((t,i) for i,t in enumerate(toks))
+    T.ids2tokens = dict((i,t) for i,t in enumerate(toks))
+    return T
+
+def make_things(cls, things, columnar=False):
+    T = cls.__new__(cls)
+    if columnar:
+        T.things = ColumnStore(cls.int_fields)
+        for t_id, t in sorted(things.items()):
+            T.things.append(t_id, t)
+        T.things.finish()
+    else:
+        T.things = things
+    return T
+
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        rng = Random(0)
+        words = [a+b+c for a in 'bcdfg' for b in 'aeiou' for c in 'lmnrst']
+        self.SC = StringCleaner(STOP_WORDS_F)
+        self.Words = make_tokens(words[:100])
+        job_ids, user_ids = range(7, 7*800, 7), range(3, 3*600, 3)
+        self.JobTokens, self.UserTokens = make_tokens(job_ids), make_tokens(user_ids)
+        text = lambda n: ' '.join(rng.choice(words + ['the','and','of']) for _ in xrange(n))
+        self.Jobs = make_things(Jobs, dict((j, {'Title':text(rng.randint(0,6)),
+                                                'Description':text(rng.randint(0,40))})
+                                           for j in job_ids))
+        self.Users = make_things(Users, dict((u, {'Major':text(rng.randint(0,4))}) for u in user_ids),
+                                 columnar=True)
+        
+    def dok_counts(self, Things, ThingTokens, field, rem_stopwords, transpose=False):
+        '''the counts built one cell at a time, as the builders originally did'''
+        shape = (ThingTokens.token_count(), self.Words.token_count())
+        d = dok_matrix(shape)
+        for tok, ind in ThingTokens.tokens2ids.iteritems():
+            for w in self.SC.clean(Things[tok][field], rem_stopwords=rem_stopwords).split(' '):
+                if w in self.Words.tokens2ids:
+                    d[ind, self.Words.tokens2ids[w]] += 1
+        return d.T.tocsr() if transpose else d.tocsr()
+    
+    def assertSameCounts(self, a, b):
+        self.assertEqual(a.shape, b.shape)
+        self.assertEqual(abs(a - b).sum(), 0)
+        
+    def test_title_job_sharded(self):
+        serial = TitleJobOccurs(self.Jobs, self.JobTokens, self.Words, self.SC).occurs
+        sharded = TitleJobOccurs(self.Jobs, self.JobTokens, self.Words, self.SC, workers=4).occurs
+        self.assertSameCounts(serial, sharded)
+        self.assertSameCounts(serial, self.dok_counts(self.Jobs, self.JobTokens, 'Title', False, True))
+        
+    def test_job_words_sharded(self):
+        # the job words builder counts the characters of the cleaned text
+        letters = make_tokens(list('abcdefghijklmnopqrstuvwxyz'))
+        serial = JobWordsJobOccurs(self.Jobs, self.JobTokens, letters, self.SC, 'Description').occurs
+        sharded = JobWordsJobOccurs(self.Jobs, self.JobTokens, letters, self.SC, 'Description',
+                                    workers=3).occurs
+        self.assertSameCounts(serial, sharded)
+        self.assertGreater(serial.sum(), 0)
+        
+    def test_user_major_sharded(self):
+        serial = UserMajorOccurs(self.Users, self.UserTokens, self.Words, self.SC).occurs
+        sharded = UserMajorOccurs(self.Users, self.UserTokens, self.Words, self.SC, workers=5,
+                                  max_buffer=7).occurs
+        self.assertSameCounts(serial, sharded)
+        self.assertSameCounts(serial, self.dok_counts(self.Users, self.UserTokens, 'Major', False))
+        
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,81 @@
+'''
+recommend_all must resume an interrupted run from its checkpoint, giving
+the same submission as an uninterrupted run, and refuse checkpoints of
+another run
+'''
+import unittest
+import os
+import sys
+import shutil
+import tempfile
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from recommender import Recommender
+from things_loaders import Users
+from tokens import Tokens
+
+
+class StubRecommender(Recommender):
+    '''recommends user index + k for every user, failing at batch fail_at'''
+
+    def __init__(self, n_users, fail_at=None):
+        self.UserTokens = Tokens()
+        self.UserTokens.tokens2ids = dict((i+1000,i) for i in range(n_users))
+        self.UserTokens.ids2tokens = dict((i,i+1000) for i in range(n_users))
+        self.Users = Users.__new__(Users)
+        self.Users.things = dict((i+1000, {'WindowID':i%3+1}) for i in range(n_users))
+        self.fail_at = fail_at
+
+    def _recommend_batch(self, args):
+        b_id, u_inds, k = args[:3]
+        if b_id == self.fail_at:
+            raise Exception('batch %d failed' % b_id)
+        return b_id, ['%d\t%d\n' % (u+1000, u+k) for u in u_inds]
+
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.users = range(0, 100, 2)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def run_all(self, R, name, k=10, batch_size=7, users=None):
+        out_f = os.path.join(self.dir, name)
+        R.recommend_all(self.users if users is None else users, k, out_f, batch_size=batch_size)
+        return open(out_f).read()
+
+    def interrupt(self, name, fail_at=3):
+        self.assertRaisesRegexp(Exception, 'batch %d failed' % fail_at, self.run_all,
+                                StubRecommender(100, fail_at), name)
+        # a partly written batch after the last finished one
+        f = open(os.path.join(self.dir, name), 'a')
+        f.write('1042\t5')
+        f.close()
+
+    def test_resume(self):
+        expected = self.run_all(StubRecommender(100), 'full.tsv')
+        self.interrupt('resumed.tsv')
+        key, done, offset = Recommender.read_checkpoint(os.path.join(self.dir, 'resumed.tsv.ckpt'))
+        self.assertEqual(done, set([0, 1, 2]))
+        self.assertEqual(self.run_all(StubRecommender(100), 'resumed.tsv'), expected)
+        self.assertEqual(expected.count('\n'), len(self.users) + 1)
+
+    def test_refuse_other_run(self):
+        self.interrupt('out.tsv')
+        for kwargs in ({'k':11}, {'batch_size':8}, {'users':self.users[:-1]}):
+            self.assertRaisesRegexp(Exception, 'checkpoint', self.run_all, StubRecommender(100),
+                                    'out.tsv', **kwargs)
+
+    def test_no_checkpoint_key(self):
+        # checkpoints written before the run key was stored can't be checked
+        self.interrupt('out.tsv')
+        ckpt_f = os.path.join(self.dir, 'out.tsv.ckpt')
+        lines = [l for l in open(ckpt_f) if not l.startswith('#')]
+        open(ckpt_f, 'w').writelines(lines)
+        self.assertRaisesRegexp(Exception, 'checkpoint', self.run_all, StubRecommender(100), 'out.tsv')
+
+
+if __name__ == "__main__":
+    unittest.main()
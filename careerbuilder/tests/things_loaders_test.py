@@ -0,0 +1,63 @@
+'''
+Jobs loaded lazily (Description and Requirements read from the file on
+access) must look the same as jobs loaded eagerly, for both the dict and
+the columnar backends
+'''
+import unittest
+import os
+import sys
+import shutil
+import tempfile
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from things_loaders import Jobs
+
+HEADER = 'JobID\tWindowID\tTitle\tDescription\tRequirements\tCity\tState\tCountry\tZip5\tStartDate\tEndDate\n'
+
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.jobs_f = os.path.join(self.dir, 'jobs.tsv')
+        f = open(self.jobs_f, 'w')
+        f.write(HEADER)
+        self.ids = range(5, 5*60, 5)
+        for j in self.ids:
+            zip5 = '' if j % 3 == 0 else str(92000 + j)
+            f.write('%d\t%d\tTitle %d\t<p>desc %d</p>\treq %d\tCity\tCA\tUS\t%s\t2012-04-01 00:00:00\t'
+                    '2012-04-20 23:59:59\n' % (j, j % 7, j % 4, j, j, zip5))
+        f.close()
+        self.eager = [Jobs(self.jobs_f, columnar=c) for c in (False, True)]
+        self.lazy = [Jobs(self.jobs_f, columnar=c, lazy=True) for c in (False, True)]
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_dicts(self):
+        for j in self.ids:
+            expected = self.eager[0][j]
+            for J in self.eager[1:] + self.lazy:
+                self.assertEqual(J[j], expected)
+                self.assertEqual(expected, J[j])
+                self.assertEqual(sorted(J[j].keys()), sorted(expected.keys()))
+                self.assertTrue('Description' in J[j])
+            self.assertEqual(self.lazy[0][j], self.lazy[1][j])
+            self.assertFalse(self.lazy[0][j] != self.lazy[1][j])
+
+    def test_field(self):
+        for j in self.ids:
+            for f in ('Title', 'Description', 'Requirements', 'Zip', 'WindowID'):
+                expected = self.eager[0].field(j, f)
+                for J in self.eager[1:] + self.lazy:
+                    self.assertEqual(J.field(j, f), expected)
+
+    def test_fields_of(self):
+        toks = self.ids[::-2]
+        for f in ('Title', 'Description', 'Requirements', 'Zip'):
+            expected = self.eager[0].fields_of(f, toks).tolist()
+            for J in self.eager[1:] + self.lazy:
+                self.assertEqual(J.fields_of(f, toks).tolist(), expected)
+
+
+if __name__ == "__main__":
+    unittest.main()
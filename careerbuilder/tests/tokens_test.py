@@ -0,0 +1,69 @@
+'''
+Tokens saved with save_binary must load back the same, memory-mapped or
+not, for integer, byte string and unicode tokens
+'''
+import unittest
+import os
+import sys
+import shutil
+import tempfile
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from tokens import Tokens, StringTokenArrays
+
+def make_tokens(toks):
+    T = Tokens()
+    T.tokens2ids = dict((t,i) for i,t in enumerate(toks))
+    T.ids2tokens = dict((i,t) for i,t in enumerate(toks))
+    return T
+
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def round_trip(self, toks, missing):
+        T = make_tokens(toks)
+        out_dir = os.path.join(self.dir, 'tokens')
+        T.save_binary(out_dir)
+        for kwargs in ({}, {'mmap_mode':None}, {'compact':False}):
+            L = Tokens()
+            L.load(out_dir, **kwargs)
+            self.assertEqual(L.token_count(), len(toks))
+            for i, t in enumerate(toks):
+                self.assertEqual(L.token2id(t), i)
+                self.assertEqual(L.id2token(i), t)
+                self.assertEqual(type(L.id2token(i)), type(t))
+            for t in missing:
+                self.assertFalse(t in L.tokens2ids)
+            self.assertEqual(dict(L.tokens2ids.items()), T.tokens2ids)
+            # bulk lookups take tokens of one type
+            same = [t for t in missing if isinstance(t, type(toks[0]))]
+            ids, not_found = L.tokens2ids_bulk(list(toks) + same)
+            self.assertEqual(ids.tolist(), range(len(toks)) + [-1]*len(same))
+            self.assertEqual(L.ids2tokens_bulk(range(len(toks)))[0].tolist(), list(toks))
+        shutil.rmtree(out_dir)
+
+    def test_int_tokens(self):
+        self.round_trip([7, 3, 1000003, 12], [4, -1, 'a'])
+
+    def test_str_tokens(self):
+        self.round_trip(['nurse', 'cook', '', 'driver', 'cooks'], ['coo', 'zz', 3])
+
+    def test_unicode_tokens(self):
+        self.round_trip([u'caf\xe9', u'cafe', u'\u65e5\u672c', u'a'], [u'caf', u'b', 'x'])
+
+    def test_mmapped(self):
+        T = make_tokens(['b%d' % i for i in range(100)])
+        T.save_binary(self.dir)
+        L = Tokens()
+        L.load(self.dir)
+        self.assertTrue(isinstance(L.arrays, StringTokenArrays))
+        self.assertEqual(L.token2id('b42'), 42)
+
+
+if __name__ == "__main__":
+    unittest.main()
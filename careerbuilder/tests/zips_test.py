@@ -0,0 +1,109 @@
+'''
+Geocodes, distances and the spatial index over zips
+'''
+import unittest
+import os
+import sys
+import shutil
+import tempfile
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from numpy import array, array_equal, column_stack, nonzero, sort
+from numpy.random import RandomState
+from zips import Zips, GeoCodes, SpatialIndex
+from things_loaders import Jobs
+from tokens import Tokens
+
+def make_tokens(toks):
+    T = Tokens()
+    T.tokens2ids = dict((t,i) for i,t in enumerate(toks))
+    T.ids2tokens = dict((i,t) for i,t in enumerate(toks))
+    return T
+
+
+class GeoCodesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.Zips = Zips.__new__(Zips)
+        self.Zips.zips = {92064:{'lat':32.9,'long':-117.0}, 73301:{'lat':30.2,'long':-97.7}}
+        self.Zips.cities = {('austin','tx'):{'lat':30.2,'long':-97.7}}
+        self.Jobs = Jobs.__new__(Jobs)
+        self.Jobs.things = {1:{'Zip':92064,'City':'Poway','State':'CA'},
+                            5:{'Zip':None,'City':'Austin','State':'TX'},
+                            9:{'Zip':11111,'City':'Nowhere','State':'ZZ'}}
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_cached_rebuilds_for_other_tokens(self):
+        prefix = os.path.join(self.dir, 'geo', 'jobs.geo')
+        geo = GeoCodes.cached(prefix, self.Jobs, make_tokens([1, 5, 9]), self.Zips)
+        self.assertTrue(array_equal(geo.known, [True, True, False]))
+        # same number of tokens in another order
+        geo = GeoCodes.cached(prefix, self.Jobs, make_tokens([9, 1, 5]), self.Zips)
+        self.assertTrue(array_equal(geo.known, [False, True, True]))
+        self.assertTrue(array_equal(geo.latlong[1:], array([[32.9, -117.0], [30.2, -97.7]])))
+
+
+class DistTableTest(unittest.TestCase):
+
+    def test_zip_dist_same_with_or_without_table(self):
+        rs = RandomState(0)
+        Z = Zips.__new__(Zips)
+        Z.zips = dict((90000+i, {'lat':rs.uniform(25,49), 'long':rs.uniform(-124,-67)}) for i in range(60))
+        Z.build_dist_table(range(90000, 90040))
+        Z2 = Zips.__new__(Zips)
+        Z2.zips = Z.zips
+        Z2.build_dist_table(range(90020, 90060))
+        for _ in range(200):
+            a, b = rs.randint(90000, 90060, 2)
+            self.assertEqual(Z.zip_dist(a, b), Z2.zip_dist(a, b))
+        Z3 = Zips.__new__(Zips)
+        Z3.zips = Z.zips
+        self.assertAlmostEqual(Z3.zip_dist(90001, 90050), Z.zip_dist(90001, 90050), places=2)
+
+
+class SpatialIndexTest(unittest.TestCase):
+    '''queries must return the points and distances a scan with Zips.lat_long_dist finds'''
+
+    def setUp(self):
+        rs = RandomState(0)
+        n = 3000
+        # clustered like zips, with a few far away points and unknown locations
+        centers = column_stack([rs.uniform(25, 49, 30), rs.uniform(-124, -67, 30)])
+        c = rs.randint(0, 30, n)
+        self.lats = centers[c,0] + rs.normal(0, 0.5, n)
+        self.longs = centers[c,1] + rs.normal(0, 0.5, n)
+        self.lats[:20], self.longs[:20] = rs.uniform(-60, 70, 20), rs.uniform(-180, 180, 20)
+        self.valid = rs.rand(n) > 0.05
+        self.index = SpatialIndex(self.lats, self.longs, self.valid)
+        self.queries = column_stack([self.lats[rs.randint(0, n, 200)] + rs.normal(0, 0.2, 200),
+                                     self.longs[rs.randint(0, n, 200)] + rs.normal(0, 0.2, 200)])
+        self.rs = rs
+
+    def scan(self, lat, long_):
+        inds = nonzero(self.valid)[0]
+        return inds, Zips.lat_long_dist(lat, long_, self.lats[inds], self.longs[inds])
+
+    def test_query_radius(self):
+        for (lat, long_), r in zip(self.queries, self.rs.choice([0.5, 5, 30, 100, 1000], 200)):
+            inds, dists = self.index.query_radius(lat, long_, r)
+            all_inds, all_dists = self.scan(lat, long_)
+            within = all_dists <= r
+            self.assertEqual(sorted(inds.tolist()), sorted(all_inds[within].tolist()))
+            self.assertTrue(array_equal(dists, sort(all_dists[within])))
+            self.assertTrue(array_equal(dists, Zips.lat_long_dist(lat, long_, self.lats[inds],
+                                                                  self.longs[inds])))
+
+    def test_query_nearest(self):
+        for (lat, long_), k in zip(self.queries, self.rs.randint(1, 300, 200)):
+            inds, dists = self.index.query_nearest(lat, long_, k)
+            all_inds, all_dists = self.scan(lat, long_)
+            self.assertEqual(len(inds), k)
+            self.assertTrue(array_equal(dists, sort(all_dists)[:k]))
+            self.assertTrue(array_equal(dists, Zips.lat_long_dist(lat, long_, self.lats[inds],
+                                                                  self.longs[inds])))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,20 +1,324 @@
 '''
 This loads things from tsv files for careerbuilder from disk
 '''
+import os
+import mmap
+import hashlib
+import cPickle
+from array import array as growable
 from pylab import *
 
+class ColumnStore(object):
+    '''
+    Stores things by column instead of as one dict per thing.  Integer
+    fields are int64 arrays with a mask of the values that were None, all
+    other fields are int32 codes into the list of the field's distinct
+    values.  Rows are ordered by thing id and found by binary search.
+    '''
+    
+    def __init__(self, int_fields):
+        self.int_fields = set(int_fields)
+        self.fields = None
+        self.ids = growable('l')
+        
+    def append(self, thing_id, thing):
+        '''add a thing (a dict of field values); call finish() after the last one'''
+        if self.fields is None:
+            self.fields = sorted(thing.keys())
+            self.values = dict((f,growable('l')) for f in self.fields)
+            self.valid = dict((f,growable('b')) for f in self.int_fields)
+            self.categories = dict((f,[]) for f in self.fields if f not in self.int_fields)
+            self.category_codes = dict((f,{}) for f in self.categories)
+        self.ids.append(thing_id)
+        for f in self.fields:
+            v = thing[f]
+            if f in self.int_fields:
+                self.values[f].append(0 if v is None else v)
+                self.valid[f].append(v is not None)
+            else:
+                codes = self.category_codes[f]
+                try:
+                    code = codes[v]
+                except KeyError:
+                    code = codes[v] = len(self.categories[f])
+                    self.categories[f].append(v)
+                self.values[f].append(code)
+                
+    def finish(self):
+        '''convert the columns to numpy arrays sorted by thing id'''
+        ids = frombuffer(self.ids, dtype=int_) if len(self.ids) else zeros(0, dtype=int_)
+        order = argsort(ids, kind='mergesort')
+        self.ids = ids[order]
+        if self.fields is None:
+            self.fields, self.values, self.valid, self.categories = [], {}, {}, {}
+        for f in self.fields:
+            dtype = int64 if f in self.int_fields else int32
+            self.values[f] = array(self.values[f], dtype=dtype)[order]
+            if f in self.int_fields:
+                self.valid[f] = array(self.valid[f], dtype=bool)[order]
+        # the code lookups are only needed while appending
+        del self.category_codes
+        return self
+    
+    def rows(self, thing_ids):
+        '''
+        Returns
+        -------
+        (rows, missing) - the row of each thing id; rows is -1 where missing is True
+        '''
+        thing_ids = asarray(thing_ids)
+        if len(self.ids) == 0:
+            return -ones(thing_ids.shape, dtype=int_), ones(thing_ids.shape, dtype=bool)
+        rows = searchsorted(self.ids, thing_ids).clip(0, len(self.ids) - 1)
+        missing = (self.ids[rows] != thing_ids) | zeros(thing_ids.shape, dtype=bool)
+        return where(missing, -1, rows), missing
+    
+    def row(self, thing_id):
+        r = self.ids.searchsorted(thing_id)
+        if r == len(self.ids) or self.ids.item(r) != thing_id:
+            raise KeyError(thing_id)
+        return r
+    
+    def value(self, field, row):
+        v = self.values[field].item(row)
+        if field in self.int_fields:
+            return v if self.valid[field].item(row) else None
+        return self.categories[field][v]
+    
+    def field(self, thing_id, field):
+        '''one field of one thing, without building the thing's dict'''
+        return self.value(field, self.row(thing_id))
+    
+    def column(self, field, rows=None, missing=-1):
+        '''
+        Parameters
+        ----------
+        field: str
+               the field name (e.g. 'WindowID')
+        rows: numpy array of ints, optional
+              the rows to return, all rows by default
+        missing: int
+                 the value returned for None in integer fields
+
+        Returns
+        -------
+        numpy array - integer fields as int64, other fields as an object array
+        of their values
+        '''
+        if rows is None:
+            rows = slice(None)
+        v = self.values[field][rows]
+        if field in self.int_fields:
+            return where(self.valid[field][rows], v, missing)
+        return array(self.categories[field], dtype=object)[v]
+    
+    def codes(self, field, rows=None):
+        '''the categorical codes of a non-integer field and the list of categories'''
+        if rows is None:
+            rows = slice(None)
+        return self.values[field][rows], self.categories[field]
+    
+    def __getitem__(self, thing_id):
+        r = self.row(thing_id)
+        return dict((f,self.value(f,r)) for f in self.fields)
+    
+    def __contains__(self, thing_id):
+        return not self.rows([thing_id])[1][0]
+    
+    def __len__(self):
+        return len(self.ids)
+    
+
+class LazyFieldReader(object):
+    '''
+    Reads fields of a thing straight from its line in the memory-mapped
+    source file, given the byte offset of the line
+    '''
+    
+    def __init__(self, things_f, delim, columns):
+        '''columns: dict mapping field names to their column in the file'''
+        self.things_f, self.delim, self.columns = things_f, delim, columns
+        f = open(things_f, 'rb')
+        self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        f.close()
+        
+    def read(self, offset, field):
+        end = self.mm.find('\n', offset)
+        if end < 0:
+            end = len(self.mm)
+        return self.mm[offset:end].strip().split(self.delim)[self.columns[field]]
+    
+    
+class LazyThing(dict):
+    '''a thing dict whose lazy fields are read from the source file on first access'''
+    
+    def __init__(self, thing, reader):
+        dict.__init__(self, thing)
+        self.offset = self.pop('_offset')
+        self.reader = reader
+        
+    def __missing__(self, field):
+        if field not in self.reader.columns:
+            raise KeyError(field)
+        value = self[field] = self.reader.read(self.offset, field)
+        return value
+    
+    def get(self, field, default=None):
+        try:
+            return self[field]
+        except KeyError:
+            return default
+
+    def load(self):
+        '''read every lazy field that hasn't been read yet'''
+        for field in self.reader.columns:
+            if not dict.__contains__(self, field):
+                self[field]
+        return self
+
+    # the lazy fields are part of the thing whether or not they were read
+    def __contains__(self, field):
+        return dict.__contains__(self, field) or field in self.reader.columns
+
+    has_key = __contains__
+
+    def keys(self):
+        return dict.keys(self) + [f for f in self.reader.columns if not dict.__contains__(self, f)]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    iterkeys = __iter__
+
+    def __len__(self):
+        return len(self.keys())
+
+    def items(self):
+        return dict.items(self.load())
+
+    def iteritems(self):
+        return dict.iteritems(self.load())
+
+    def values(self):
+        return dict.values(self.load())
+
+    def itervalues(self):
+        return dict.itervalues(self.load())
+
+    def copy(self):
+        '''a plain dict of all fields'''
+        return dict(dict.items(self.load()))
+
+    def __eq__(self, other):
+        if isinstance(other, LazyThing):
+            other.load()
+        return dict.__eq__(self.load(), other)
+
+    def __ne__(self, other):
+        return not self == other
+
+
 class Things(object):
     '''stores information associated with things (e.g. users, jobs, etc)'''
+    
+    # fields parsed as ints, stored as arrays by the columnar backend
+    int_fields = ()
+    # a LazyFieldReader if some fields are only read from disk when accessed
+    lazy = None
         
-    def load_things(self,things_file,delim):
-        '''load things from flatfile with format thing\tattrib\tattrib'''
-        things = {}
-        header = things_file.readline().strip().split(delim)
+    def load_things(self,things_file,delim,columnar=False,lazy_fields=()):
+        '''
+        load things from flatfile with format thing\tattrib\tattrib
+
+        if columnar, the things are stored in a ColumnStore instead of a dict
+        of dicts.  Fields in lazy_fields are dropped and the byte offset of each
+        thing's line is kept in its '_offset' field instead.
+        '''
+        int_fields = self.int_fields + (('_offset',) if lazy_fields else ())
+        things = ColumnStore(int_fields) if columnar else {}
+        header = things_file.readline()
+        offset = len(header)
         for l in things_file:
             thing_id, thing_dict = self.parse_thing(l.strip().split(delim))
-            things[thing_id] = thing_dict
+            if lazy_fields:
+                for f in lazy_fields:
+                    del thing_dict[f]
+                thing_dict['_offset'] = offset
+            offset += len(l)
+            if columnar:
+                things.append(thing_id, thing_dict)
+            else:
+                things[thing_id] = thing_dict
+        if columnar:
+            things.finish()
         return things
     
+    def load_cached(self, things_f, delim, columnar=False, lazy_fields=(), cache_dir=None,
+                    rebuild=False):
+        '''
+        load_things through a snapshot cache
+
+        The parsed things are pickled to a snapshot in cache_dir on the first
+        load and read back from it on later loads, as long as the fingerprint
+        of things_f (see Things.fingerprint) and delim are unchanged;
+        otherwise, or if rebuild, the file is parsed again and the snapshot
+        rewritten.  Without a cache_dir this is just load_things.
+        '''
+        if cache_dir is None:
+            return self.load_things(open(things_f),delim,columnar,lazy_fields)
+        path = self.snapshot_path(things_f, cache_dir, columnar, lazy_fields)
+        key = (Things.fingerprint(things_f), delim)
+        if not rebuild and os.path.exists(path):
+            f = open(path,'rb')
+            try:
+                if cPickle.load(f) == key:
+                    return cPickle.load(f)
+            except (EOFError, cPickle.UnpicklingError):
+                pass
+            finally:
+                f.close()
+        things = self.load_things(open(things_f),delim,columnar,lazy_fields)
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        tmp = path + '.%d.tmp' % os.getpid()
+        f = open(tmp,'wb')
+        cPickle.dump(key, f, cPickle.HIGHEST_PROTOCOL)
+        cPickle.dump(things, f, cPickle.HIGHEST_PROTOCOL)
+        f.close()
+        os.rename(tmp, path)
+        return things
+    
+    def snapshot_path(self, things_f, cache_dir, columnar=False, lazy_fields=()):
+        '''the snapshot file for things_f loaded by this class with these options'''
+        name = '%s.%s' % (os.path.basename(things_f), type(self).__name__)
+        if columnar:
+            name += '.columnar'
+        if lazy_fields:
+            name += '.lazy'
+        return os.path.join(cache_dir, name + '.snapshot')
+    
+    @staticmethod
+    def fingerprint(things_f, sample=2**20):
+        '''(size, mtime, md5 of the first and last sample bytes) of things_f'''
+        st = os.stat(things_f)
+        md5 = hashlib.md5()
+        f = open(things_f,'rb')
+        md5.update(f.read(sample))
+        f.seek(max(st.st_size - sample, 0))
+        md5.update(f.read(sample))
+        f.close()
+        return (st.st_size, st.st_mtime, md5.hexdigest())
+    
+    @staticmethod
+    def invalidate_cache(things_f, cache_dir):
+        '''delete every snapshot of things_f in cache_dir'''
+        if not os.path.isdir(cache_dir):
+            return
+        prefix = os.path.basename(things_f) + '.'
+        for name in os.listdir(cache_dir):
+            if name.startswith(prefix) and name.endswith('.snapshot'):
+                os.remove(os.path.join(cache_dir, name))
+    
     def parse_thing(self,line):
         pass
     
@@ -39,16 +343,65 @@ class Things(object):
         return zip
     
     def __getitem__(self,thing_id):
+        if self.lazy is not None:
+            return LazyThing(self.things[thing_id], self.lazy)
         return self.things[thing_id]
     
     def __len__(self):
         return len(self.things)
+    
+    def field(self, thing_id, name):
+        '''
+        one field of one thing; unlike self[thing_id][name] this doesn't
+        build the thing's dict for columnar things
+        '''
+        if self.lazy is not None and name in self.lazy.columns:
+            return self.lazy.read(self.field(thing_id, '_offset'), name)
+        if isinstance(self.things, ColumnStore):
+            return self.things.field(thing_id, name)
+        return self.things[thing_id][name]
+    
+    def fields_of(self, field, thing_ids, missing=-1):
+        '''
+        the field of many things (by id) as a numpy array, vectorized for
+        columnar things; None in integer fields comes back as missing
+        '''
+        if self.lazy is not None and field in self.lazy.columns:
+            offsets = self.fields_of('_offset', thing_ids).tolist()
+            return array([self.lazy.read(o, field) for o in offsets], dtype=object)
+        if isinstance(self.things, ColumnStore):
+            rows, not_found = self.rows(thing_ids)
+            if not_found.any():
+                raise KeyError(asarray(thing_ids)[not_found][0])
+            return self.column(field, rows, missing=missing)
+        values = [self.things[t][field] for t in asarray(thing_ids).tolist()]
+        if field in self.int_fields:
+            return array([missing if v is None else v for v in values],
+                         dtype=int64 if isinstance(missing, (int,long)) else object)
+        return array(values, dtype=object)
+    
+    def column(self, field, rows=None, **kwargs):
+        '''vectorized access to a field, see ColumnStore.column (columnar only)'''
+        return self._column_store().column(field, rows, **kwargs)
+    
+    def rows(self, thing_ids):
+        '''the rows of thing ids for column(), see ColumnStore.rows (columnar only)'''
+        return self._column_store().rows(thing_ids)
+    
+    def _column_store(self):
+        if not isinstance(self.things, ColumnStore):
+            raise Exception('column access needs things loaded with columnar=True')
+        return self.things
 
 class Users(Things):
     '''stores users information'''
     
-    def __init__(self, users_file='/media/kaggle/careerbuilder/data/users.tsv', delim='\t'):
-        self.things = self.load_things(open(users_file),delim)
+    int_fields = ('WindowID','Zip','WorkHistoryCount','TotalYearsExperience','ManagedHowMany')
+    
+    def __init__(self, users_file='/media/kaggle/careerbuilder/data/users.tsv', delim='\t',
+                 columnar=False, cache_dir=None):
+        '''if cache_dir is given, the parsed users are cached there (see Things.load_cached)'''
+        self.things = self.load_cached(users_file,delim,columnar,cache_dir=cache_dir)
         
     def parse_thing(self, line):
         u = {}
@@ -71,8 +424,23 @@ class Users(Things):
 class Jobs(Things):
     '''stores jobs information'''
     
-    def __init__(self, jobs_file='/media/kaggle/careerbuilder/data/jobs.tsv', delim='\t'):
-        self.things = self.load_things(open(jobs_file),delim)
+    int_fields = ('WindowID','Zip')
+    # the large text fields and their columns in jobs.tsv
+    lazy_columns = {'Description':3, 'Requirements':4}
+    
+    def __init__(self, jobs_file='/media/kaggle/careerbuilder/data/jobs.tsv', delim='\t',
+                 columnar=False, lazy=False, cache_dir=None):
+        '''
+        if lazy, Description and Requirements are not kept in memory; they are
+        read from the memory-mapped jobs_file when a job's field is accessed.
+        If cache_dir is given, the parsed jobs are cached there (see
+        Things.load_cached).
+        '''
+        lazy_fields = ()
+        if lazy:
+            self.lazy = LazyFieldReader(jobs_file, delim, Jobs.lazy_columns)
+            lazy_fields = tuple(Jobs.lazy_columns)
+        self.things = self.load_cached(jobs_file,delim,columnar,lazy_fields,cache_dir)
         
     def parse_thing(self, line):
         j = {}
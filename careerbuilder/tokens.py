@@ -2,8 +2,321 @@
 This is a more general class than lexicon (specific for words) but accomplishes
 similar things.
 '''
+import os
+import mmap
+from itertools import izip
 from pylab import *
 from data_cleansing import *
+from parallel import fork_map, byte_ranges, read_range
+
+class TokenArrays(object):
+    '''
+    Array backed mapping between tokens and ids (ids must be 0..n-1)
+
+    id_tokens holds the token of each id; tokens are looked up either in a
+    dense table indexed by the token (small non-negative integer tokens) or
+    by binary search in the sorted tokens.
+    '''
+    
+    def __init__(self, id_tokens, order=None, dense_factor=4):
+        '''
+        Parameters
+        ----------
+        id_tokens: numpy array
+                   id_tokens[id] is the token with that id
+        order: numpy array, optional
+               argsort of id_tokens, computed if not given
+        dense_factor: int
+                      integer tokens use a dense lookup table when the largest
+                      token is below dense_factor * number of tokens
+        '''
+        self.id_tokens = id_tokens
+        self.n = n = id_tokens.shape[0]
+        self.lut = None
+        if (n > 0 and id_tokens.dtype.kind in 'iu' and id_tokens.min() >= 0
+            and id_tokens.max() < dense_factor * n):
+            self.lut = -ones(id_tokens.max() + 1, dtype=int32 if n < 2**31 else int64)
+            self.lut[id_tokens] = arange(n)
+            self.lut_size = self.lut.shape[0]
+            self.order = self.sorted_tokens = None
+        else:
+            if order is None:
+                order = argsort(id_tokens, kind='mergesort')
+            self.order = order
+            self.sorted_tokens = id_tokens[order]
+            
+    @staticmethod
+    def from_dict(ids2tokens, **kwargs):
+        '''build from an {id: token} dictionary whose ids are 0..n-1'''
+        n = len(ids2tokens)
+        ids = fromiter(ids2tokens.iterkeys(), dtype=int64, count=n)
+        tokens = array(ids2tokens.values())
+        if n and (ids.min() != 0 or ids.max() != n - 1):
+            raise ValueError('token ids must be 0..n-1')
+        id_tokens = empty_like(tokens)
+        id_tokens[ids] = tokens
+        return TokenArrays(id_tokens, **kwargs)
+    
+    def __len__(self):
+        return self.id_tokens.shape[0]
+            
+    def lookup_tokens(self, tokens):
+        '''
+        Returns
+        -------
+        (ids, missing) - ids is -1 where missing (a boolean array) is True
+        '''
+        tokens = asarray(tokens)
+        if len(self) == 0:
+            return -ones(tokens.shape, dtype=int64), ones(tokens.shape, dtype=bool)
+        if self.lut is not None:
+            if tokens.dtype.kind not in 'iu':
+                return -ones(tokens.shape, dtype=int64), ones(tokens.shape, dtype=bool)
+            ids = -ones(tokens.shape, dtype=int64)
+            inside = (tokens >= 0) & (tokens < self.lut.shape[0])
+            ids[inside] = self.lut[tokens[inside]]
+        else:
+            pos = searchsorted(self.sorted_tokens, tokens).clip(0, len(self) - 1)
+            found = (self.sorted_tokens[pos] == tokens) | zeros(tokens.shape, dtype=bool)
+            ids = where(found, self.order[pos], -1)
+        return ids, ids < 0
+    
+    def lookup_token(self, token):
+        '''the id of a single token, or -1 if it is missing, without building arrays'''
+        lut = self.lut
+        if lut is not None:
+            if isinstance(token, (int, long, integer)) and 0 <= token < self.lut_size:
+                return lut.item(token)
+            return -1
+        try:
+            pos = self.sorted_tokens.searchsorted(token)
+        except (TypeError, ValueError):
+            return -1
+        if pos < self.n and self.sorted_tokens[pos] == token:
+            return self.order.item(pos)
+        return -1
+    
+    def lookup_ids(self, ids):
+        '''
+        Returns
+        -------
+        (tokens, missing) - tokens of ids outside 0..n-1 are undefined
+        '''
+        ids = asarray(ids)
+        missing = (ids < 0) | (ids >= len(self))
+        return self.id_tokens[where(missing, 0, ids)], missing
+    
+    def token(self, id):
+        '''the token of id, which must be in 0..n-1'''
+        return self.id_tokens.item(id)
+    
+    def tokens(self):
+        '''list of the tokens by id'''
+        return self.id_tokens.tolist()
+        
+
+class StringTokenArrays(object):
+    '''
+    String tokens stored as a blob of their concatenated UTF-8 bytes and the
+    offset of each id's token in it, with the ids in byte order of their
+    tokens for binary search.  The blob and the arrays can be memory-mapped,
+    so a large vocabulary is opened without reading it; a lookup costs
+    log(n) slices of the blob, slower than a dictionary.  Same interface as
+    TokenArrays.
+    '''
+    
+    def __init__(self, offsets, blob, order, is_unicode):
+        '''
+        Parameters
+        ----------
+        offsets: numpy array
+                 the token of id i is blob[offsets[i]:offsets[i+1]]
+        blob: str or mmap
+              the concatenated UTF-8 encoded tokens
+        order: numpy array
+               the ids sorted by the bytes of their tokens
+        is_unicode: boolean
+                    if true, tokens are decoded to unicode, otherwise they
+                    are returned as byte strings
+        '''
+        self.offsets, self.blob, self.order, self.is_unicode = offsets, blob, order, is_unicode
+        self.n = offsets.shape[0] - 1
+        
+    @staticmethod
+    def encode(tokens):
+        '''
+        Returns
+        -------
+        (list of the tokens as UTF-8 byte strings, True if any token was unicode)
+        '''
+        is_unicode = bool(any([isinstance(t, unicode) for t in tokens]))
+        return [t.encode('utf-8') if isinstance(t, unicode) else t for t in tokens], is_unicode
+    
+    def save(self, out_dir):
+        save(os.path.join(out_dir,'offsets.npy'),asarray(self.offsets))
+        save(os.path.join(out_dir,'order.npy'),asarray(self.order))
+        save(os.path.join(out_dir,'unicode.npy'),array(self.is_unicode))
+        f = open(os.path.join(out_dir,'blob.bin'),'wb')
+        f.write(self.blob[:])
+        f.close()
+    
+    @staticmethod
+    def from_tokens(tokens):
+        '''build from the list of tokens by id'''
+        encoded, is_unicode = StringTokenArrays.encode(tokens)
+        offsets = zeros(len(encoded) + 1, dtype=int64)
+        offsets[1:] = cumsum([len(t) for t in encoded])
+        order = array(sorted(xrange(len(encoded)), key=encoded.__getitem__), dtype=int64)
+        return StringTokenArrays(offsets, ''.join(encoded), order, is_unicode)
+    
+    @staticmethod
+    def load(in_dir, mmap_mode='r'):
+        '''opens the arrays written by save, memory-mapped unless mmap_mode is None'''
+        offsets = load(os.path.join(in_dir,'offsets.npy'),mmap_mode=mmap_mode)
+        blob_f = os.path.join(in_dir,'blob.bin')
+        if mmap_mode is not None and os.path.getsize(blob_f) > 0:
+            f = open(blob_f,'rb')
+            blob = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            f.close()
+        else:
+            blob = open(blob_f,'rb').read()
+        if not os.path.exists(os.path.join(in_dir,'order.npy')):
+            # saved before the order and encoding were stored: byte strings
+            arrays = StringTokenArrays(offsets, blob, None, False)
+            return StringTokenArrays.from_tokens(arrays.tokens())
+        order = load(os.path.join(in_dir,'order.npy'),mmap_mode=mmap_mode)
+        is_unicode = bool(load(os.path.join(in_dir,'unicode.npy')))
+        return StringTokenArrays(offsets, blob, order, is_unicode)
+    
+    def __len__(self):
+        return self.n
+    
+    def token_bytes(self, id):
+        return self.blob[self.offsets.item(id):self.offsets.item(id + 1)]
+    
+    def token(self, id):
+        '''the token of id, which must be in 0..n-1'''
+        t = self.token_bytes(id)
+        return t.decode('utf-8') if self.is_unicode else t
+    
+    def tokens(self):
+        '''list of the tokens by id'''
+        return [self.token(i) for i in xrange(self.n)]
+    
+    def lookup_token(self, token):
+        '''the id of a single token, or -1 if it is missing'''
+        if isinstance(token, unicode):
+            try:
+                key = token.encode('utf-8')
+            except UnicodeError:
+                return -1
+        elif isinstance(token, str):
+            key = token
+        else:
+            return -1
+        lo, hi = 0, self.n
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.token_bytes(self.order.item(mid)) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.n and self.token_bytes(self.order.item(lo)) == key:
+            return self.order.item(lo)
+        return -1
+    
+    def lookup_tokens(self, tokens):
+        '''
+        Returns
+        -------
+        (ids, missing) - ids is -1 where missing (a boolean array) is True
+        '''
+        tokens = asarray(tokens, dtype=object)
+        ids = fromiter((self.lookup_token(t) for t in tokens.ravel().tolist()),
+                       dtype=int64, count=tokens.size).reshape(tokens.shape)
+        return ids, ids < 0
+    
+    def lookup_ids(self, ids):
+        '''
+        Returns
+        -------
+        (tokens, missing) - tokens of ids outside 0..n-1 are undefined
+        '''
+        ids = asarray(ids)
+        missing = (ids < 0) | (ids >= self.n)
+        safe = where(missing, 0, ids).ravel().tolist()
+        if self.n == 0:
+            return array([''] * len(safe)).reshape(ids.shape), missing
+        return array([self.token(i) for i in safe]).reshape(ids.shape), missing
+        
+
+class TokenIdMap(object):
+    '''read-only {token: id} dictionary view of a TokenArrays'''
+    
+    def __init__(self, arrays):
+        self.arrays = arrays
+        
+    def __getitem__(self, token):
+        id = self.arrays.lookup_token(token)
+        if id < 0:
+            raise KeyError(token)
+        return id
+    
+    def __contains__(self, token):
+        return self.arrays.lookup_token(token) >= 0
+    
+    def get(self, token, default=None):
+        try:
+            return self[token]
+        except KeyError:
+            return default
+    
+    def __len__(self):
+        return len(self.arrays)
+    
+    def __iter__(self):
+        return iter(self.arrays.tokens())
+    
+    iterkeys = __iter__
+    
+    def keys(self):
+        return self.arrays.tokens()
+    
+    def values(self):
+        return range(len(self.arrays))
+    
+    def iteritems(self):
+        return izip(self.arrays.tokens(), xrange(len(self.arrays)))
+    
+    def items(self):
+        return list(self.iteritems())
+    
+    
+class IdTokenMap(TokenIdMap):
+    '''read-only {id: token} dictionary view of a TokenArrays'''
+    
+    def __getitem__(self, id):
+        if isinstance(id, (int, long, integer)) and 0 <= id < self.arrays.n:
+            return self.arrays.token(id)
+        raise KeyError(id)
+    
+    def __contains__(self, id):
+        return isinstance(id, (int, long, integer)) and 0 <= id < self.arrays.n
+    
+    def __iter__(self):
+        return iter(xrange(len(self.arrays)))
+    
+    iterkeys = __iter__
+    
+    def keys(self):
+        return range(len(self.arrays))
+    
+    def values(self):
+        return self.arrays.tokens()
+    
+    def iteritems(self):
+        return izip(xrange(len(self.arrays)), self.arrays.tokens())
+    
 
 class Tokens(object):
     '''Tokens are unique identifiers for things (e.g. words, user names, user IDs, etc)'''
@@ -40,6 +353,63 @@ class Tokens(object):
     def id2token(self, id):
         return self.ids2tokens[id]
     
+    def compact(self, dense_factor=4):
+        '''
+        Replaces the tokens2ids/ids2tokens dictionaries with a TokenArrays and
+        read-only dictionary views of it, which take a fraction of the memory.
+        Lookups keep working; the tokens can no longer be modified.
+        '''
+        self.arrays = TokenArrays.from_dict(self.ids2tokens, dense_factor=dense_factor)
+        self.tokens2ids = TokenIdMap(self.arrays)
+        self.ids2tokens = IdTokenMap(self.arrays)
+        
+    def is_compact(self):
+        return isinstance(self.tokens2ids, TokenIdMap)
+    
+    def token_arrays(self):
+        '''
+        the TokenArrays of the tokens: the compacted ones, otherwise built
+        from the dictionaries as they are now (they may have been changed)
+        '''
+        if self.is_compact():
+            return self.tokens2ids.arrays
+        return TokenArrays.from_dict(self.ids2tokens)
+        
+    def tokens2ids_bulk(self, tokens):
+        '''
+        Maps an array of tokens to ids at once, vectorized for compacted
+        tokens and by dictionary lookups otherwise
+
+        Returns
+        -------
+        (ids, missing) - numpy arrays; ids is -1 where missing is True
+        '''
+        if self.is_compact():
+            return self.tokens2ids.arrays.lookup_tokens(tokens)
+        tokens, t2i = asarray(tokens), self.tokens2ids
+        ids = fromiter((t2i.get(t, -1) for t in tokens.ravel().tolist()),
+                       dtype=int64, count=tokens.size).reshape(tokens.shape)
+        return ids, ids < 0
+    
+    def ids2tokens_bulk(self, ids):
+        '''
+        Maps an array of ids to tokens at once, vectorized for compacted
+        tokens and by dictionary lookups otherwise
+
+        Returns
+        -------
+        (tokens, missing) - numpy arrays; missing marks ids that are not
+        0..n-1, their tokens are undefined
+        '''
+        if self.is_compact():
+            return self.ids2tokens.arrays.lookup_ids(ids)
+        ids, i2t = asarray(ids), self.ids2tokens
+        ids_l = ids.ravel().tolist()
+        missing = array([i not in i2t for i in ids_l], dtype=bool).reshape(ids.shape)
+        fill = next(i2t.itervalues()) if i2t else 0
+        tokens = array([i2t.get(i, fill) for i in ids_l]).reshape(ids.shape)
+        return tokens, missing
+    
     def save(self, outfile, delim='\t'):
         f = open(outfile,'w')
         for id,token in self.ids2tokens.iteritems():
@@ -55,6 +425,69 @@ class Tokens(object):
             id = int(id)
             self.tokens2ids[token] = id
             self.ids2tokens[id] = token
+            
+    def save_binary(self, out_dir):
+        '''
+        Saves the tokens as binary arrays in out_dir.  Integer tokens are
+        stored as tokens.npy (the token of each id) and order.npy (their
+        argsort); string tokens as a blob.bin of the concatenated UTF-8
+        encoded tokens, their offsets.npy and order.npy (see
+        StringTokenArrays), and whether they were unicode.
+        '''
+        if not os.path.isdir(out_dir):
+            os.makedirs(out_dir)
+        arrays = self.token_arrays()
+        if isinstance(arrays, StringTokenArrays):
+            arrays.save(out_dir)
+        elif arrays.id_tokens.dtype.kind in 'iu':
+            id_tokens = arrays.id_tokens
+            save(os.path.join(out_dir,'tokens.npy'),id_tokens.astype(int64))
+            order = arrays.order
+            if order is None:
+                order = argsort(id_tokens, kind='mergesort')
+            save(os.path.join(out_dir,'order.npy'),order)
+        else:
+            StringTokenArrays.from_tokens(arrays.tokens()).save(out_dir)
+    
+    def load_tokens_binary(self, in_dir, mmap_mode='r', compact=True):
+        '''
+        Loads tokens written by save_binary
+
+        Parameters
+        ----------
+        in_dir: str
+                directory written by save_binary
+        mmap_mode: str or None
+                   the token arrays (and the blob of string tokens) are
+                   memory-mapped with this mode
+        compact: boolean
+                 if true, the tokens stay in arrays (see Tokens.compact and
+                 StringTokenArrays), otherwise the tokens2ids/ids2tokens
+                 dictionaries are built; string token lookups in arrays are
+                 slower than in dictionaries, so load with compact=False for
+                 lookup heavy work
+        '''
+        if os.path.exists(os.path.join(in_dir,'blob.bin')):
+            arrays = StringTokenArrays.load(in_dir, mmap_mode)
+        else:
+            id_tokens = load(os.path.join(in_dir,'tokens.npy'),mmap_mode=mmap_mode)
+            order = load(os.path.join(in_dir,'order.npy'),mmap_mode=mmap_mode)
+            arrays = TokenArrays(id_tokens, order=order)
+        if compact:
+            self.arrays = arrays
+            self.tokens2ids = TokenIdMap(self.arrays)
+            self.ids2tokens = IdTokenMap(self.arrays)
+        else:
+            tokens = arrays.tokens()
+            self.tokens2ids = dict(izip(tokens, xrange(len(tokens))))
+            self.ids2tokens = dict(enumerate(tokens))
+            
+    def load(self, path, **kwargs):
+        '''load tokens from a save_binary directory or a .tok text file'''
+        if os.path.isdir(path):
+            self.load_tokens_binary(path, **kwargs)
+        else:
+            self.load_tokens_flat(path, **kwargs)
         
     def token_count(self):
         return len(self.tokens2ids)
@@ -79,20 +512,60 @@ class ZipsTokens(Tokens):
             self.ids2tokens[i] = z
             i += 1   
             
+class FlatFileWordCounter(object):
+    '''
+    Counts the cleaned words of one column of a flat file in parallel: the
+    file is split into byte ranges, each worker process counts one range in
+    a counter of the same kind (and memory budget) as the one counted into,
+    and the partial counters are merged into it.  With a WordCounter the
+    merged counts are the same as a serial count's, but words with equal
+    counts may be ordered differently.
+    '''
+    
+    def __init__(self, StringCleaner, col, delim='\t'):
+        self.SC, self.col, self.delim = StringCleaner, col, delim
+        
+    def count(self, f_name, WC, workers, header=True):
+        '''count f_name with workers processes and merge the counts into WC'''
+        ranges = [(f_name, start, end) for start, end in byte_ranges(f_name, workers, header)]
+        self.WC = WC
+        try:
+            for part in fork_map(self, 'count_range', ranges, workers):
+                WC.merge_counter(part)
+        finally:
+            self.WC = None
+            
+    def count_range(self, args):
+        '''returns a counter (made by spawn from the one being counted into) of one byte range'''
+        f_name, start, end = args
+        WC = self.WC.spawn()
+        lines = (l.strip().split(self.delim) for l in read_range(f_name, start, end))
+        cols = (l[self.col] for l in lines if len(l) > self.col)
+        for s in self.SC.clean_many(cols):
+            if s == '': continue
+            WC.count_words(s)
+        return WC
+    
+            
 class TitlesTokens(Tokens):
     
-    def __init__(self):
+    def __init__(self, max_words=None):
+        '''if max_words is set, words are counted approximately in a fixed memory budget'''
         self.SC = StringCleaner()
-        self.WC = WordCounter()
+        self.WC = WordCounter() if max_words is None else ApproxWordCounter(max_words)
         
-    def count_words_from_flat(self, f_name, title_col, header=True):
+    def count_words_from_flat(self, f_name, title_col, header=True, workers=1):
+        '''with workers > 1, byte ranges of the file are counted in parallel'''
+        if workers > 1:
+            counter = FlatFileWordCounter(self.SC, title_col)
+            counter.count(f_name, self.WC, workers, header)
+            return
         f = open(f_name)
         if header:
             f.readline() 
-        for l in f:
-            l = l.strip().split('\t')
-            if len(l) < title_col + 1: continue
-            s = self.SC.clean(l[title_col])
+        lines = (l.strip().split('\t') for l in f)
+        titles = (l[title_col] for l in lines if len(l) >= title_col + 1)
+        for s in self.SC.clean_many(titles):
             if s == '': continue
             self.WC.count_words(s)
         f.close()
@@ -113,19 +586,26 @@ class TitlesTokens(Tokens):
             
 class MajorsTokens(Tokens):
     
-    def tokenize_flat_file(self,f_name,title_col,top_N_words=10000,min_count=5):
+    def tokenize_flat_file(self,f_name,title_col,top_N_words=10000,min_count=5,
+                           max_words=None,workers=1):
+        '''
+        if max_words is set, words are counted approximately in a fixed memory budget;
+        with workers > 1, byte ranges of the file are counted in parallel
+        '''
         SC = StringCleaner()
-        WC = WordCounter()
-        f = open(f_name)
-        header = f.readline()
+        WC = WordCounter() if max_words is None else ApproxWordCounter(max_words)
         self.words = {}
 
-        for l in f:
-            l = l.strip().split('\t')
-            s = SC.clean(l[title_col])
-            if s == '': continue
-            WC.count_words(s)
-        f.close()
+        if workers > 1:
+            FlatFileWordCounter(SC, title_col).count(f_name, WC, workers)
+        else:
+            f = open(f_name)
+            header = f.readline()
+            titles = (l.strip().split('\t')[title_col] for l in f)
+            for s in SC.clean_many(titles):
+                if s == '': continue
+                WC.count_words(s)
+            f.close()
         
         WC.prune_by_count(min_count)
         WC.keep_top_N(top_N_words)
@@ -1,5 +1,7 @@
+import os
+import hashlib
 import numpy
-numpy.seterr(all='raise')
+from numpy.lib.format import open_memmap
 from pylab import *
 
 
@@ -29,13 +31,25 @@ class Zips(object):
         return zips_dict, city_dict
                        
     def zip_dist(self, zip1, zip2):
-        '''find the distance (miles) between zip1 and zip2'''
+        '''
+        find the haversine distance (miles) between zip1 and zip2, from the
+        distance table if one was built or loaded and holds both zips.
+        With a table, distances outside it are rounded to the table's dtype
+        too, so a pair gets the same distance whichever zips were tabled.
+        '''
         if zip1 == zip2:
             return 0
+        table = getattr(self, 'dist_table', None)
+        if table is not None:
+            pos = searchsorted(self.table_zips, [zip1,zip2]).clip(0, len(self.table_zips) - 1)
+            if self.table_zips[pos[0]] == zip1 and self.table_zips[pos[1]] == zip2:
+                return float(table[pos[0],pos[1]])
         lat1,long1 = self.lat_long_lookup(zip1)
         lat2,long2 = self.lat_long_lookup(zip2)
-        
-        return Zips.lat_long_dist(lat1,long1,lat2,long2)
+        dist = Zips.haversine(lat1,long1,lat2,long2)
+        if table is not None:
+            dist = dist.astype(table.dtype)
+        return float(dist)
     
     def lat_long_lookup(self, place):
         '''
@@ -60,15 +74,282 @@ class Zips(object):
                     cos(radians(lat_A)) *
                     cos(radians(lat_B)) *
                     cos(radians(long_A - long_B)))
+        # rounding can push the cosine just past 1
+        return (degrees(arccos(clip(distance,-1.0,1.0)))) * 69.09
+    
+    @staticmethod
+    def haversine(lat_A, long_A, lat_B, long_B, dtype=float64):
+        '''
+        return distance in miles between lat/long coordinates with the
+        haversine formula, which stays accurate for nearby points
+
+        The arguments broadcast against each other (e.g. one point against
+        arrays of points); dtype=float32 halves memory and bandwidth.
+        '''
+        lat_A, long_A = radians(asarray(lat_A, dtype=dtype)), radians(asarray(long_A, dtype=dtype))
+        lat_B, long_B = radians(asarray(lat_B, dtype=dtype)), radians(asarray(long_B, dtype=dtype))
+        a = (sin((lat_B - lat_A) / 2) ** 2 +
+             cos(lat_A) * cos(lat_B) * sin((long_B - long_A) / 2) ** 2)
+        return (degrees(2 * arcsin(sqrt(clip(a, 0, 1)))) * 69.09).astype(dtype)
+    
+    @staticmethod
+    def pairwise_dist(lats_A, longs_A, lats_B, longs_B, dtype=float64, block=1024, out=None):
+        '''
+        Many-to-many haversine distances
+
+        Parameters
+        ----------
+        lats_A, longs_A: numpy arrays of length n
+        lats_B, longs_B: numpy arrays of length m
+        dtype: numpy dtype
+               float64 or float32
+        block: int
+               rows of the result computed at once, bounds the temporaries
+        out: numpy array, optional
+             (n,m) array (e.g. a memmap) to write the distances into
+
+        Returns
+        -------
+        (n,m) numpy array of distances in miles
+        '''
+        lats_A, longs_A = asarray(lats_A), asarray(longs_A)
+        if out is None:
+            out = empty((lats_A.shape[0],len(lats_B)), dtype=dtype)
+        for start in range(0, lats_A.shape[0], block):
+            stop = start + block
+            out[start:stop] = Zips.haversine(lats_A[start:stop,None], longs_A[start:stop,None],
+                                             lats_B, longs_B, dtype)
+        return out
+    
+    def build_dist_table(self, zips, dtype=float32, out_prefix=None):
+        '''
+        Fills a zip x zip distance table that zip_dist reads from
+
+        Parameters
+        ----------
+        zips: list of ints
+              the zips to include (e.g. those of users and jobs); the table
+              takes len(zips)**2 values, ~7GB of float32 for every zip
+        dtype: numpy dtype
+               the distances are computed in float64 and stored as dtype
+        out_prefix: str, optional
+                    if given, the table is written to out_prefix.dist.npy (as a
+                    memmap, so it can be larger than memory) and the zips to
+                    out_prefix.zips.npy, for load_dist_table; otherwise it is
+                    kept in memory
+        '''
+        zips = unique(array([z for z in zips if z in self.zips], dtype=int64))
+        lats = array([self.zips[z]['lat'] for z in zips.tolist()])
+        longs = array([self.zips[z]['long'] for z in zips.tolist()])
+        if out_prefix is not None:
+            save(out_prefix + '.zips.npy', zips)
+            out = open_memmap(out_prefix + '.dist.npy', mode='w+', dtype=dtype,
+                              shape=(len(zips),len(zips)))
+        else:
+            out = empty((len(zips),len(zips)), dtype=dtype)
+        self.dist_table = Zips.pairwise_dist(lats, longs, lats, longs, float64, out=out)
+        self.table_zips = zips
+        if out_prefix is not None:
+            out.flush()
+            
+    def load_dist_table(self, prefix, mmap_mode='r'):
+        '''load a distance table written by build_dist_table'''
+        self.table_zips = load(prefix + '.zips.npy')
+        self.dist_table = load(prefix + '.dist.npy', mmap_mode=mmap_mode)
+
+class GeoCodes(object):
+    '''
+    Lat/long of every thing (e.g. user or job) by its token index, with a
+    mask of the things whose location is known (unknown ones are 0, 0)
+    '''
+    
+    def __init__(self, latlong, known):
+        self.latlong, self.known = latlong, known
+        
+    @staticmethod
+    def build(Thing, ThingTokens, Zips):
+        '''
+        Geocodes every token of ThingTokens at once: zips are looked up with
+        one binary search over all zips, and only the things without a known
+        zip fall back to a (city, state) lookup
+        '''
+        n = ThingTokens.token_count()
+        toks = ThingTokens.ids2tokens_bulk(arange(n))[0]
+        zips = asarray(Thing.fields_of('Zip', toks, missing=-1), dtype=int64)
+        zip_codes = array(sorted(Zips.zips.iterkeys()), dtype=int64)
+        zip_latlong = array([[Zips.zips[z]['lat'], Zips.zips[z]['long']] for z in zip_codes.tolist()])
+        latlong = zeros((n,2))
+        known = zeros(n, dtype=bool)
+        if len(zip_codes):
+            pos = searchsorted(zip_codes, zips).clip(0, len(zip_codes) - 1)
+            known = zip_codes[pos] == zips
+            latlong[known] = zip_latlong[pos[known]]
+        for i in nonzero(~known)[0]:
+            try:
+                latlong[i] = Zips.lat_long_lookup((Thing.field(toks[i], 'City'), Thing.field(toks[i], 'State')))
+                known[i] = True
+            except KeyError:
+                continue
+        return GeoCodes(latlong, known)
+    
+    @staticmethod
+    def cached(prefix, Thing, ThingTokens, Zips, mmap_mode='r'):
+        '''
+        load the geocodes saved at prefix, building and saving them first if
+        they are missing or stale: saved for other tokens, or in another
+        order, than ThingTokens (see tokens_key).  Changes to Thing or Zips
+        alone aren't detected, delete the files to rebuild them.
+        '''
+        key = GeoCodes.tokens_key(ThingTokens)
+        if os.path.exists(prefix + '.key') and open(prefix + '.key').read() == key:
+            return GeoCodes.load(prefix, mmap_mode)
+        GeoCodes.build(Thing, ThingTokens, Zips).save(prefix, key)
+        return GeoCodes.load(prefix, mmap_mode)
+    
+    @staticmethod
+    def tokens_key(ThingTokens):
+        '''md5 of the tokens of ThingTokens in id order, the rows of the geocodes'''
+        toks = ThingTokens.ids2tokens_bulk(arange(ThingTokens.token_count()))[0]
+        md5 = hashlib.md5()
+        if toks.dtype.kind in 'iu':
+            md5.update(asarray(toks, dtype=int64).tostring())
+        else:
+            md5.update(repr(toks.tolist()))
+        return md5.hexdigest()
+        
+    def save(self, prefix, key=None):
+        '''
+        save as prefix.latlong.npy and prefix.known.npy (e.g. next to the
+        tokens), and the key of the tokens they were built for (see
+        tokens_key) as prefix.key
+        '''
+        out_dir = os.path.dirname(prefix)
+        if out_dir and not os.path.isdir(out_dir):
+            os.makedirs(out_dir)
+        if os.path.exists(prefix + '.key'):
+            # a crash while the arrays are rewritten mustn't leave a matching key
+            os.remove(prefix + '.key')
+        save(prefix + '.latlong.npy', self.latlong)
+        save(prefix + '.known.npy', self.known)
+        if key is not None:
+            f = open(prefix + '.key', 'w')
+            f.write(key)
+            f.close()
+        
+    @staticmethod
+    def load(prefix, mmap_mode='r'):
+        return GeoCodes(load(prefix + '.latlong.npy', mmap_mode=mmap_mode),
+                        load(prefix + '.known.npy', mmap_mode=mmap_mode))
+    
+    def lat_long(self, ind):
+        '''(lat, long) of the thing at index ind, or None if unknown'''
+        if not self.known[ind]:
+            return None
+        return self.latlong[ind,0], self.latlong[ind,1]
+    
+
+class SpatialIndex(object):
+    '''
+    A grid index over lat/long points for radius and nearest neighbor queries.
 
-        try:
-            return (degrees(arccos(distance))) * 69.09
-        except FloatingPointError:
-            if isinstance(distance,float):
-                distance = 1.0
-            else:
-                distance[distance>1.0] = 1.0
-            return (degrees(arccos(distance))) * 69.09
+    Points are mapped to 3d unit vectors and bucketed into cubic cells whose
+    side is cell_miles of chord length, so a query only visits the cells its
+    radius can reach.  Distances are computed with Zips.lat_long_dist, so
+    they are exactly the values it returns.
+    '''
+    
+    def __init__(self, lats, longs, valid=None, cell_miles=25.0):
+        '''
+        Parameters
+        ----------
+        lats, longs: numpy arrays
+                     coordinates of the points, in degrees
+        valid: boolean numpy array, optional
+               only these points are indexed (e.g. those with a known location)
+        cell_miles: float
+                    the cell size
+        '''
+        self.lats, self.longs = asarray(lats, dtype=float), asarray(longs, dtype=float)
+        if valid is None:
+            valid = ones(self.lats.shape, dtype=bool)
+        inds = nonzero(valid)[0]
+        self.cell = SpatialIndex.chord(cell_miles)
+        self.K = int(ceil(1.0 / self.cell))
+        codes = self._codes(self._cells(SpatialIndex.to_xyz(self.lats[inds], self.longs[inds])))
+        order = argsort(codes, kind='mergesort')
+        self.inds = inds[order]
+        self.cell_codes, self.starts = unique(codes[order], return_index=True)
+        self.ends = append(self.starts[1:], len(self.inds))
+        
+    @staticmethod
+    def to_xyz(lats, longs):
+        '''unit vectors of lat/long coordinates, shape (n,3)'''
+        lats, longs = radians(lats), radians(longs)
+        return column_stack([cos(lats) * cos(longs), cos(lats) * sin(longs), sin(lats)])
+    
+    @staticmethod
+    def chord(miles):
+        '''the straight line distance on the unit sphere spanning miles'''
+        theta = radians(miles / 69.09)
+        return 2.0 * sin(min(theta, pi) / 2.0)
+    
+    def _cells(self, xyz):
+        return floor(xyz / self.cell).astype(int64)
+    
+    def _codes(self, cells):
+        side = 2 * self.K + 1
+        cells = cells + self.K
+        return (cells[:,0] * side + cells[:,1]) * side + cells[:,2]
+        
+    def query_radius(self, lat, long_, max_dist):
+        '''
+        Finds the points within max_dist miles of (lat, long_)
+
+        Returns
+        -------
+        (inds, dists) - indices of the points and their distances, nearest first
+        '''
+        if len(self.inds) == 0:
+            return zeros(0, dtype=int), zeros(0)
+        q = SpatialIndex.to_xyz(array([lat]), array([long_]))[0]
+        # pad the reach a little so rounding never drops a point on the boundary
+        reach = SpatialIndex.chord(max_dist) * (1 + 1e-9) + 1e-12
+        lo = self._cells((q - reach)[None,:])[0].clip(-self.K, self.K)
+        hi = self._cells((q + reach)[None,:])[0].clip(-self.K, self.K)
+        n_box = prod(hi - lo + 1)
+        if n_box >= len(self.cell_codes):
+            cand = self.inds
+        else:
+            grid = indices(hi - lo + 1).reshape(3, -1).T + lo
+            codes = self._codes(grid)
+            pos = searchsorted(self.cell_codes, codes).clip(0, len(self.cell_codes) - 1)
+            pos = pos[self.cell_codes[pos] == codes]
+            if len(pos) == 0:
+                return zeros(0, dtype=int), zeros(0)
+            cand = concatenate([self.inds[self.starts[p]:self.ends[p]] for p in pos])
+        dists = Zips.lat_long_dist(lat, long_, self.lats[cand], self.longs[cand])
+        keep = dists <= max_dist
+        cand, dists = cand[keep], dists[keep]
+        order = argsort(dists, kind='mergesort')
+        return cand[order], dists[order]
+    
+    def query_nearest(self, lat, long_, k, start_dist=25.0):
+        '''
+        Finds the k points nearest to (lat, long_) by growing a radius query
+        until it holds k points
+
+        Returns
+        -------
+        (inds, dists) - indices of the points and their distances, nearest first
+        '''
+        k = min(k, len(self.inds))
+        r = start_dist
+        while True:
+            inds, dists = self.query_radius(lat, long_, r)
+            if len(inds) >= k or r > 69.09 * 180:
+                return inds[:k], dists[:k]
+            r *= 2
+    
 
 if __name__ == "__main__":
     Zips = Zips()